@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+"""
+    Level of the home battery: in - uit + productie = accumulatie
+    - in: zero, the battery is not charged from the grid
+    - uit: consumption per hour, constant (3500 kWh/year = 0.4 kWh/hour)
+    - productie: energy of the solar panels per hour
+    The level is kept between 0 and the capacity. Once the battery is
+    empty the level is NaN for the rest of the period.
+
+    The level is computed for all hours at once (no loop over the rows):
+    with S the cumulative accumulatie, the level is start + S minus what
+    was lost because the battery was full, which is the running maximum
+    of start + S above the capacity.
+
+    Capacity, consumption and start can be arrays of scenarios, they are
+    broadcast against the leading axes of productie, e.g.
+    capaciteit=np.array([[5], [7], [10]]) and verbruik=np.array([0.3, 0.4])
+    give the levels of 3 x 2 scenarios in one call.
+"""
+
+import logging
+
+import numpy as np
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+CAPACITEIT = 7  # kWh
+VERBRUIK = 3500 / 365 / 24  # kWh per hour
+
+
+def simuleren(productie, capaciteit=CAPACITEIT, verbruik=VERBRUIK, start=None):
+    """
+        Level of the battery per hour
+
+        :param productie: energy per hour [kWh], the last axis is time
+        :param capaciteit: capacity [kWh], scalar or array of scenarios
+        :param verbruik: consumption per hour [kWh], scalar or array of scenarios
+        :param start: level at the first hour [kWh], default a full battery
+        :return array of levels [kWh], shape of productie broadcast with
+                the scenarios, NaN from the hour the battery is empty
+    """
+    productie = np.asarray(productie, dtype=float)
+    capaciteit = np.asarray(capaciteit, dtype=float)[..., None]
+    verbruik = np.asarray(verbruik, dtype=float)[..., None]
+    start = capaciteit if start is None else np.asarray(start, dtype=float)[..., None]
+
+    # The level of hour i follows from the production of hour i - 1
+    accumulatie = productie[..., :-1] - verbruik
+    cumulatief = np.cumsum(accumulatie, axis=-1)
+    cumulatief = np.concatenate(
+        [np.zeros(cumulatief.shape[:-1] + (1,)), cumulatief], axis=-1
+    )
+
+    # Without a maximum, and what is lost when the battery is full
+    niveau = start + cumulatief
+    niveau = niveau - np.maximum(0, np.maximum.accumulate(niveau, axis=-1) - capaciteit)
+
+    leeg = np.logical_or.accumulate(niveau <= 0, axis=-1)
+    return np.where(leeg, np.nan, niveau)
+
+
+def leeg_vanaf(niveau):
+    """
+        First hour the battery is empty
+
+        :param niveau: result of simuleren
+        :return position on the last axis, -1 when the battery lasts the
+                whole period (array for scenarios)
+    """
+    leeg = np.isnan(niveau)
+    return np.where(leeg.any(axis=-1), leeg.argmax(axis=-1), -1)
+
+
+if __name__ == "__main__":
+    print("\n\nThe batterij.py is directly called, not supposed to do so...\n\n")
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+"""
+    Benchmarks of the data pipeline, on generated data (no network needed)
+
+    Usage: python benchmark.py [name ...]
+"""
+
+import argparse
+import coloredlogs, logging
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import batterij
+import ophalen_weersvoorspelling
+import tunen
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
+
+
+def timeit(function, repeat=5):
+    """
+        Best time of repeat runs [s]
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def ipluim_bestand(names, points, seed=0):
+    """
+        Generates an iPluim file with series names, each with points values
+    """
+    rng = np.random.default_rng(seed)
+    times = 1_650_000_000_000 + np.arange(points) * 3_600_000
+    series = [
+        {"name": name, "data": [[int(t), float(v)] for t, v in zip(times, rng.uniform(0, 100, points))]}
+        for name in names
+    ]
+    # Extra series which are not used, like in the real files
+    series += [{"name": f"Member {i}", "data": [[int(t), 0.0] for t in times]} for i in range(10)]
+    return json.dumps({"series": series}).encode()
+
+
+def merge_chain(contents):
+    """
+        The parser before parse_voorspelling: one DataFrame per series and merges
+    """
+    frames = {}
+    for kolom, (url, weights) in ophalen_weersvoorspelling.SERIES.items():
+        parts = None
+        for serie in json.loads(contents[url])["series"]:
+            if serie.get("name") in weights:
+                part = pd.DataFrame(serie["data"], columns=["time", serie["name"]])
+                parts = part if parts is None else parts.merge(part, on="time")
+        parts["Tijdstip"] = pd.to_datetime(parts["time"], unit="ms")
+        parts.set_index("Tijdstip", inplace=True)
+        frames[kolom] = sum(weight * parts[name] for name, weight in weights.items())
+
+    voorspelling = None
+    for kolom, values in frames.items():
+        values = values.rename(kolom).to_frame()
+        voorspelling = values if voorspelling is None else voorspelling.merge(
+            values, left_index=True, right_index=True
+        )
+    return voorspelling
+
+
+def bench_ipluim(points=5000):
+    """
+        iPluim parser: merge chain against parse_voorspelling
+    """
+    names = {}
+    for url, weights in ophalen_weersvoorspelling.SERIES.values():
+        names.setdefault(url, []).extend(weights)
+    contents = {url: ipluim_bestand(wanted, points) for url, wanted in names.items()}
+
+    # Same result
+    oud = merge_chain(contents)
+    nieuw = ophalen_weersvoorspelling.parse_voorspelling(contents)
+    pd.testing.assert_frame_equal(oud, nieuw, check_freq=False, check_names=False)
+
+    t_oud = timeit(lambda: merge_chain(contents))
+    t_nieuw = timeit(lambda: ophalen_weersvoorspelling.parse_voorspelling(contents))
+    logger.info(f"iPluim, {points} points per series")
+    logger.info(f"  merge chain:        {t_oud * 1000:8.1f} ms")
+    logger.info(f"  parse_voorspelling: {t_nieuw * 1000:8.1f} ms ({t_oud / t_nieuw:.1f}x)")
+    logger.info(f"  JSON decoder: {ophalen_weersvoorspelling.json_loads.__module__}")
+
+
+def batterij_loop(productie, capaciteit=batterij.CAPACITEIT, verbruik=batterij.VERBRUIK):
+    """
+        The battery level before batterij.simuleren: a loop over the hours
+    """
+    niveau = [capaciteit]
+    leeg = False
+    for i in range(1, len(productie)):
+        huidig = max(min(capaciteit, niveau[-1] - verbruik + productie[i - 1]), 0)
+        if huidig == 0 or leeg:
+            leeg = True
+            huidig = np.nan
+        niveau.append(huidig)
+    return np.array(niveau)
+
+
+def bench_batterij(hours=24 * 365, scenarios=100):
+    """
+        Battery level: loop over the hours against batterij.simuleren,
+        for one forecast and for a sweep over capacities
+    """
+    rng = np.random.default_rng(0)
+    uur = np.arange(hours) % 24
+    productie = np.where((uur > 6) & (uur < 20), rng.uniform(0, 1.5, hours), 0)
+    capaciteiten = np.linspace(1, 20, scenarios)
+
+    # Same result
+    np.testing.assert_allclose(batterij_loop(productie), batterij.simuleren(productie))
+    np.testing.assert_allclose(
+        batterij_loop(productie, capaciteit=capaciteiten[-1]),
+        batterij.simuleren(productie, capaciteit=capaciteiten)[-1],
+    )
+
+    t_loop = timeit(lambda: batterij_loop(productie), repeat=1)
+    t_simuleren = timeit(lambda: batterij.simuleren(productie))
+    t_sweep = timeit(lambda: batterij.simuleren(productie, capaciteit=capaciteiten))
+    logger.info(f"Battery level, {hours} hours")
+    logger.info(f"  loop:                  {t_loop * 1000:8.1f} ms")
+    logger.info(f"  simuleren:             {t_simuleren * 1000:8.1f} ms ({t_loop / t_simuleren:.1f}x)")
+    logger.info(f"  {scenarios} capacities at once: {t_sweep * 1000:8.1f} ms")
+
+
+def bench_tunen(hours=20000, trials=8):
+    """
+        Parameter search: trials one after another with all threads (as in
+        XGBoost_testen.ipynb) against the pool of tunen.uitvoeren
+    """
+    rng = np.random.default_rng(0)
+    X = rng.uniform(0, 1, (hours, 10))
+    y = 1000 * X[:, 0] * (1 - X[:, 1]) + rng.normal(0, 10, hours)
+    grid = tunen.combinaties({"eta": [0.1, 0.3], "max_depth": [3, 6], "gamma": [0, 1]})[:trials]
+
+    cores = os.cpu_count() or 1
+    t_serieel = timeit(lambda: list(tunen.uitvoeren(X, y, grid, workers=1, threads=cores)), repeat=1)
+    t_pool = timeit(lambda: list(tunen.uitvoeren(X, y, grid)), repeat=1)
+    workers = tunen.aantal_workers()
+
+    logger.info(f"Parameter search, {len(grid)} trials on {hours} rows ({cores} cores)")
+    logger.info(f"  serial, {cores} threads:         {len(grid) / t_serieel:6.2f} trials/s")
+    logger.info(
+        f"  pool, {workers} x {tunen.THREADS} threads:        {len(grid) / t_pool:6.2f} trials/s "
+        f"({t_serieel / t_pool:.1f}x)"
+    )
+
+
+BENCHMARKS = {
+    "batterij": bench_batterij,
+    "ipluim": bench_ipluim,
+    "tunen": bench_tunen,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the data pipeline")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -3,96 +3,120 @@
 
 """
     Combine data from solaredge and historical weather into one dataset
+
+    Usage: python build_dataset.py [--full] [--arrow] [--force]
+    By default only the hours after the last hour in the dataset (with some
+    overlap) are processed, and the hours from the low-water mark of the
+    sources on (hours written by the fetchers since the last build, e.g. a
+    backfilled gap). --full rebuilds the whole dataset.
+    --arrow also writes the columnar copy (dataset_store, needs pyarrow).
+
+    The steps run with pijplijn, see stappen(): the weather forecast is
+    fetched at the same time as SolarEdge and the KNMI history. A step is
+    skipped when its inputs didn't change since the last run, --force runs
+    all steps.
 """
 
 
-import sqlite3
-import pysolar
+import argparse
 import pandas as pd
 import coloredlogs, logging
 
 import ophalen_solaredge
 import ophalen_weer
 import ophalen_weersvoorspelling
+import locaties
+import dataset_store
+import features
+import inlezen
+import pijplijn
+import storage
+import tijdas
+import zonnestand
 
 
 # Start logger
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
 
+# Variabelen van het KNMI die in de dataset komen, met hun kolomnaam.
+# Alleen deze worden bij het KNMI opgehaald en opgeslagen
+WEER_KOLOMMEN = ophalen_weer.KOLOMMEN
 
-# Inlezen gegevens solaredge
-def inlezen_solaredge(conn):
-    logger.debug("Inlezen gegevens SolarEdge")
-
-    # Database inlezen
-    data = pd.read_sql("SELECT * FROM solaredge_history", conn)
-
-    # Tijd omzetten naar datetime
-    data["Time"] = pd.to_datetime(data["tijdstip"])
-    data.set_index("Time", inplace=True)
-    data.drop("tijdstip", axis=1, inplace=True)
-
-    # Tijdzone info toevoegen, SolarEdge is in de "local" time
-    data = data.tz_localize("Europe/Amsterdam", ambiguous="NaT", nonexistent="NaT")
+# Een incrementele run begint zoveel voor het laatste uur in de dataset,
+# zodat uren aan de rand (resample, late gegevens) opnieuw berekend worden
+OVERLAP = pd.Timedelta(days=1)
 
-    return data
+# Tables the dataset is combined from, their low-water marks are set by
+# the fetchers (rollups, ophalen_weer.store_batch)
+BRONNEN = ["solaredge_hourly", "knmi_history"]
 
 
-# Inlezen gegevens weer
-def inlezen_weer(conn):
-    logger.debug("Inlezen gegevens weer")
+def get_high_water_mark(conn):
+    """
+        Laatste uur (UTC) in de dataset, None als de dataset (opnieuw)
+        opgebouwd moet worden
+    """
+    if not storage.table_exists(conn, "dataset"):
+        return None
 
-    # Database inlezen
-    data = pd.read_sql("SELECT * FROM knmi_history", conn)
+    # Een oudere dataset (van pandas.to_sql, zonder epoch) eenmalig opnieuw opbouwen
+    columns = storage.table_columns(conn, "dataset")
+    if "epoch" not in {name for name, _, _ in columns}:
+        logger.info("Dataset heeft geen kolom epoch, wordt opnieuw opgebouwd")
+        return None
 
-    # Date en hour omzetten naar datetime
-    data["Time"] = pd.to_datetime(data["date"]) + pd.TimedeltaIndex(
-        data["hour"], unit="h"
-    )
-
-    data.set_index("Time", inplace=True)
-    data.drop(["date", "hour", "id", "station_code"], inplace=True, axis=1)
+    # Nieuwe features: opnieuw opbouwen, zodat ze ook voor de oude uren bestaan
+    nieuw = {spec.naam for spec in features.FEATURES} - {name for name, _, _ in columns}
+    if len(nieuw) > 0:
+        logger.info(f"Nieuwe features {', '.join(sorted(nieuw))}, dataset wordt opnieuw opgebouwd")
+        return None
 
-    # De temperatuur staat in 0.1°C, deze wordt nu door 10 gedeeld om de
-    # goede temperatuur te krijgen
-    data["T"] = data["T"] / 10
+    last = conn.execute("SELECT MAX(epoch) FROM dataset;").fetchone()[0]
+    return None if last is None else tijdas.naar_index([last])[0]
 
-    return data
 
-
-def combine_data():
+def combine_data(full=False, arrow=False, database=storage.DATABASE):
     # Open database
-    conn = sqlite3.connect("database.db")
-
-    # Zonnepanelen worden per kwartier gesampled. Met _resample_ het totaal per uur uitrekenen
-    logger.info("Inlezen SolarEdge, resample naar 1H interval")
-    zonnepanelen = inlezen_solaredge(conn).resample("1H").sum()
+    conn = storage.connect(database)
+
+    # Vanaf waar de dataset bijgewerkt wordt: na het laatste uur, of eerder
+    # als er sinds de vorige keer eerdere uren geschreven zijn
+    laagwater = storage.low_water(conn, BRONNEN)
+    start = None if full else get_high_water_mark(conn)
+    if start is None:
+        logger.info("Dataset volledig opbouwen")
+    else:
+        start = start - OVERLAP
+        if laagwater is not None:
+            start = min(start, tijdas.naar_index([laagwater])[0])
+        start = start.floor("D")
+        logger.info(f"Dataset bijwerken vanaf {start}")
+
+    # Zonnepanelen worden per kwartier gesampled, het totaal per uur wordt
+    # bijgehouden bij het ophalen (rollups)
+    logger.info("Inlezen SolarEdge per uur")
+    zonnepanelen = inlezen.solaredge_uur(conn, start=start)
 
     # Data van het weer inlezen. Samenvoegen met data zonnepanelen
     logger.info("Inlezen weer, samenvoegen met SolarEdge")
-    data = inlezen_weer(conn)
-    data = data.merge(zonnepanelen, left_index=True, right_index=True)
+    # Beide op dezelfde tijdas (UTC, gesorteerd, uniek): een join op de index
+    data = inlezen.weer(conn, start=start, columns=list(WEER_KOLOMMEN))
+    data = data.join(zonnepanelen, how="inner")
 
     # Nu ook de positie van de zon berekenen op basis van mijn positie
-    # TODO: set location from config.ini
     logger.info("Positie van de zon uitrekenen")
-    latitude = 51.2
-    longitude = 6
+    latitude, longitude = locaties.get_location()
 
-    logger.debug("Solar altitude")
-    data["alt"] = pysolar.solar.get_altitude_fast(latitude, longitude, data.index)
-
-    logger.debug("Solar azimuth")
-    data["azi"] = pysolar.solar.get_azimuth_fast(latitude, longitude, data.index)
+    zon = zonnestand.get_solar_position(latitude, longitude, data.index)
+    data["alt"] = zon["altitude"]
+    data["azi"] = zon["azimuth"]
 
     # Kolommen een begrijpelijke naam geven
     logger.info("Kolommen andere naam geven")
     data.rename(
         columns={
-            "T": "temperatuur",
-            "DR": "duur_neerslag",
-            "N": "bewolking",
+            **WEER_KOLOMMEN,
             "alt": "solar_altitude",
             "azi": "solar_azimuth",
         },
@@ -103,31 +127,104 @@ def combine_data():
     logger.info("Dataset opslaan")
     data_export = data[
         [
-            "temperatuur",
-            "duur_neerslag",
-            "bewolking",
+            *WEER_KOLOMMEN.values(),
             "solar_altitude",
             "solar_azimuth",
             "energy",
         ]
     ]
-    data_export.to_sql("dataset", con=conn, if_exists="replace")
 
-    conn.commit()
-    conn.close()
+    # Features, alleen voor de nieuwe uren (met de historie uit de dataset)
+    logger.info("Features uitrekenen")
+    data_export = data_export.join(features.bijwerken(conn, data_export, start))
 
+    data_export.insert(0, "epoch", tijdas.index_naar_epoch(data_export.index))
 
-def fetch_data():
-    logger.info("Fetching data from SolarEdge")
-    ophalen_solaredge.get_data()
+    # Bij volledig opbouwen de oude dataset weggooien, anders alleen nieuwe en
+    # gewijzigde uren schrijven
+    if start is None:
+        conn.execute("DROP TABLE IF EXISTS dataset;")
+    rows = storage.upsert_frame(conn, "dataset", data_export, ["epoch"])
+    logger.info(f"Dataset: {rows} uren toegevoegd of gewijzigd")
 
-    logger.info("Fetching weather history from KNMI")
-    ophalen_weer.get_data()
+    # De geschreven uren zitten nu in de dataset
+    if start is None:
+        storage.clear_low_water(conn, BRONNEN)
+    elif laagwater is not None:
+        storage.clear_low_water(conn, BRONNEN, laagwater)
 
-    logger.info("Fetching weather forecast from KNMI")
-    ophalen_weersvoorspelling.get_data()
+    # Kolom-georiënteerde kopie, alleen de maanden die bijgewerkt zijn
+    if arrow:
+        dataset_store.export(conn, None if start is None else data_export.index.min())
+
+    conn.close()
+
+
+def knmi_invoer(conn):
+    """
+        Inputs of the KNMI history: the period of SolarEdge. Only when the
+        history already covers it, it can be skipped (None: always fetch,
+        the KNMI publishes with some delay)
+    """
+    if not storage.table_exists(conn, "knmi_history"):
+        return None
+    first, last = conn.execute("SELECT MIN(epoch), MAX(epoch) FROM solaredge_history;").fetchone()
+    knmi_last = conn.execute("SELECT MAX(epoch) FROM knmi_history;").fetchone()[0]
+    if last is None or knmi_last is None or knmi_last < last - last % 3600:
+        return None
+    return {"solaredge": [first, last], "variabelen": list(WEER_KOLOMMEN)}
+
+
+def dataset_invoer(conn, arrow=False):
+    """
+        Inputs of the dataset: the tables it is combined from, the location
+        and the features. Aggregates over the (indexed) tables, no data is read.
+    """
+    if not all(storage.table_exists(conn, table) for table in ("dataset", "solaredge_hourly", "knmi_history")):
+        return None
+    solaredge = conn.execute(
+        "SELECT COUNT(*), MAX(epoch), SUM(energy) FROM solaredge_hourly;"
+    ).fetchone()
+    weer = conn.execute("SELECT COUNT(*), MAX(epoch) FROM knmi_history;").fetchone()
+    return {
+        "solaredge": list(solaredge),
+        "weer": list(weer),
+        "kolommen": WEER_KOLOMMEN,
+        "locatie": list(locaties.get_location()),
+        "features": [list(spec) for spec in features.FEATURES],
+        "arrow": arrow,
+    }
+
+
+def stappen(full=False, arrow=False):
+    """
+        Steps of the pipeline: only the KNMI history needs SolarEdge (for its
+        period), the forecast doesn't depend on anything
+    """
+    return [
+        pijplijn.Stap("solaredge", ophalen_solaredge.get_data),
+        pijplijn.Stap(
+            "knmi_history",
+            lambda: ophalen_weer.get_data(variables=list(WEER_KOLOMMEN)),
+            na=("solaredge",),
+            invoer=knmi_invoer,
+        ),
+        pijplijn.Stap("knmi_forecast", ophalen_weersvoorspelling.get_data),
+        pijplijn.Stap(
+            "dataset",
+            lambda: combine_data(full=full, arrow=arrow),
+            na=("solaredge", "knmi_history"),
+            invoer=lambda conn: dataset_invoer(conn, arrow),
+        ),
+    ]
 
 
 if __name__ == "__main__":
-    fetch_data()
-    combine_data()
+    parser = argparse.ArgumentParser(description="Fetch data and build the dataset")
+    parser.add_argument("--full", action="store_true", help="rebuild the whole dataset")
+    parser.add_argument("--arrow", action="store_true", help="also write the columnar dataset")
+    parser.add_argument("--force", action="store_true", help="run all steps, also when unchanged")
+    args = parser.parse_args()
+
+    force = True if args.force else ("dataset",) if args.full else ()
+    pijplijn.uitvoeren(stappen(full=args.full, arrow=args.arrow), force=force)
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+"""
+    Columnar copy of table dataset, for fast loading of training data
+    - Arrow IPC (Feather v2) files, one per month: <directory>/maand=YYYY-MM/part-0.arrow
+    - Time as timestamp (UTC), epoch as int64, all other columns float32
+    - Files are uncompressed, so readers memory-map them without copying
+      and only read the columns and months they ask for
+
+    Needs pyarrow (optional, only for this module)
+"""
+
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+import tijdas
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.feather as feather
+    import pyarrow.fs
+except ImportError:
+    pa = None
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+DIRECTORY = "dataset_arrow"
+PARTITION = "maand"
+FILENAME = "part-0.arrow"
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is needed for the columnar dataset: pip install pyarrow")
+
+
+def to_table(frame):
+    """
+        DataFrame with column Time (UTC) to an Arrow table with
+        the timestamp, epoch (int64) and float32 columns
+    """
+    values = [name for name in frame.columns if name not in ("Time", "epoch")]
+    frame = frame.astype({name: "float32" for name in values})
+
+    fields = [pa.field("Time", pa.timestamp("s", tz="UTC"))]
+    if "epoch" in frame.columns:
+        fields.append(pa.field("epoch", pa.int64()))
+    fields += [pa.field(name, pa.float32()) for name in values]
+    return pa.Table.from_pandas(frame, schema=pa.schema(fields), preserve_index=False)
+
+
+def export(conn, start=None, directory=DIRECTORY):
+    """
+        Writes the months of table dataset from start on (all months when
+        start is None). A month is always written as a whole, each file
+        is replaced atomically.
+
+        :return amount of months written
+    """
+    _require_pyarrow()
+
+    sql, params = "SELECT * FROM dataset", ()
+    if start is not None:
+        start = pd.Timestamp(start)
+        sql += " WHERE epoch >= ?"
+        params = (tijdas.naar_epoch(start.strftime("%Y-%m-01")),)
+    data = pd.read_sql(sql, conn, params=params)
+    data["Time"] = tijdas.naar_index(data["epoch"])
+
+    months = data["Time"].dt.strftime("%Y-%m")
+    for month, part in data.groupby(months):
+        path = os.path.join(directory, f"{PARTITION}={month}")
+        os.makedirs(path, exist_ok=True)
+        feather.write_feather(
+            to_table(part), os.path.join(path, FILENAME + ".tmp"), compression="uncompressed"
+        )
+        os.replace(os.path.join(path, FILENAME + ".tmp"), os.path.join(path, FILENAME))
+
+    # Full export: months which are not in the dataset anymore are removed
+    if start is None and os.path.isdir(directory):
+        written = {f"{PARTITION}={month}" for month in months.unique()}
+        for name in os.listdir(directory):
+            if name.startswith(f"{PARTITION}=") and name not in written:
+                shutil.rmtree(os.path.join(directory, name))
+
+    logger.info(f"Columnar dataset: {months.nunique()} month(s) written to {directory}")
+    return months.nunique()
+
+
+def lezen(columns=None, start=None, end=None, directory=DIRECTORY):
+    """
+        Reads the columnar dataset, only the months and columns needed
+
+        :param columns: list of columns (default all)
+        :param start, end: times (UTC when without timezone), start <= Time < end
+        :return DataFrame with index Time
+    """
+    _require_pyarrow()
+
+    dataset = ds.dataset(
+        directory,
+        format="feather",
+        partitioning="hive",
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+    )
+
+    # The filter on the month skips the files of other months
+    conditions = []
+    if start is not None:
+        start = _utc(start)
+        conditions += [ds.field(PARTITION) >= start.strftime("%Y-%m"), ds.field("Time") >= start]
+    if end is not None:
+        end = _utc(end)
+        conditions += [ds.field(PARTITION) <= end.strftime("%Y-%m"), ds.field("Time") < end]
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != PARTITION]
+    else:
+        columns = ["Time", *[name for name in columns if name != "Time"]]
+
+    data = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return data.set_index("Time").sort_index()
+
+
+def _utc(moment):
+    moment = pd.Timestamp(moment)
+    return moment.tz_localize("UTC") if moment.tz is None else moment.tz_convert("UTC")
+
+
+if __name__ == "__main__":
+    print("\n\nThe dataset_store.py is directly called, not supposed to do so...\n\n")
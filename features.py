@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+"""
+    Features for the model, computed from the hourly dataset
+    Each feature is a spec in FEATURES: name, function, column and window.
+    Adding a feature is adding a spec. The same functions are used for the
+    dataset (training) and for the forecast (scoring).
+
+    Functions:
+    - kalender: part of the time (UTC), e.g. hour or dayofyear
+    - lag: value of column window hours earlier
+    - gemiddelde: mean of column over the last window hours
+    - helder: highest value of column at the same hour of the day in the
+      previous window days, an estimate of the clear-sky production
+    - helder_ratio: value 24 hours earlier divided by helder
+"""
+
+import logging
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import inlezen
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# One feature: name of the column, function, column it is computed from, window
+Feature = namedtuple("Feature", ["naam", "functie", "kolom", "venster"])
+
+FEATURES = [
+    Feature("dayofyear", "kalender", "dayofyear", None),
+    Feature("year", "kalender", "year", None),
+    Feature("quarter", "kalender", "quarter", None),
+    Feature("month", "kalender", "month", None),
+    Feature("day", "kalender", "day", None),
+    Feature("hour", "kalender", "hour", None),
+    Feature("energy_lag_24", "lag", "energy", 24),
+    Feature("energy_lag_48", "lag", "energy", 48),
+    Feature("energy_lag_168", "lag", "energy", 168),
+    Feature("bewolking_gem_3", "gemiddelde", "bewolking", 3),
+    Feature("bewolking_gem_6", "gemiddelde", "bewolking", 6),
+    Feature("bewolking_gem_24", "gemiddelde", "bewolking", 24),
+    Feature("helder_30", "helder", "energy", 30),
+    Feature("helder_ratio_30", "helder_ratio", "energy", 30),
+]
+
+
+def _kalender(data, spec):
+    return getattr(data.index, spec.kolom)
+
+
+def _lag(data, spec):
+    return data[spec.kolom].shift(spec.venster)
+
+
+def _gemiddelde(data, spec):
+    return data[spec.kolom].rolling(spec.venster, min_periods=1).mean()
+
+
+def _helder(data, spec):
+    # Per hour of the day, the values of the previous days (not the day itself)
+    return data[spec.kolom].groupby(data.index.hour).transform(
+        lambda values: values.shift(1).rolling(spec.venster, min_periods=1).max()
+    )
+
+
+def _helder_ratio(data, spec):
+    vorige = data[spec.kolom].shift(24).to_numpy(dtype=float)
+    helder = _helder(data, spec).to_numpy(dtype=float)
+    return np.divide(vorige, helder, out=np.full_like(vorige, np.nan), where=helder > 0)
+
+
+FUNCTIES = {
+    "kalender": _kalender,
+    "lag": _lag,
+    "gemiddelde": _gemiddelde,
+    "helder": _helder,
+    "helder_ratio": _helder_ratio,
+}
+
+# Hours of history a function needs for one row
+TERUGKIJKEN = {
+    "kalender": lambda venster: 0,
+    "lag": lambda venster: venster,
+    "gemiddelde": lambda venster: venster - 1,
+    "helder": lambda venster: venster * 24,
+    "helder_ratio": lambda venster: venster * 24,
+}
+
+
+# Hours after the last known value of its column a function can still be
+# computed for (the forecast has no energy), None: no limit
+VOORUIT = {
+    "kalender": lambda venster: None,
+    "lag": lambda venster: venster,
+    "gemiddelde": lambda venster: venster - 1,
+    "helder": lambda venster: venster * 24,
+    "helder_ratio": lambda venster: 24,
+}
+
+
+def beschikbaar(horizon, specs=FEATURES, onbekend=("energy",)):
+    """
+        Features which can be computed for every hour of a forecast of
+        horizon (Timedelta) ahead, when the columns in onbekend are only
+        known up to the start of the forecast
+    """
+    uren = horizon / pd.Timedelta(hours=1)
+    return [
+        spec
+        for spec in specs
+        if spec.functie == "kalender"
+        or spec.kolom not in onbekend
+        or VOORUIT[spec.functie](spec.venster) >= uren
+    ]
+
+
+def terugkijken(specs=FEATURES):
+    """
+        History needed before the first row to compute all features
+    """
+    return pd.Timedelta(hours=max(TERUGKIJKEN[spec.functie](spec.venster) for spec in specs))
+
+
+def bronkolommen(specs=FEATURES):
+    """
+        Columns of the dataset the features are computed from
+    """
+    return sorted({spec.kolom for spec in specs if spec.functie != "kalender"})
+
+
+def bereken(data, specs=FEATURES):
+    """
+        Computes the features
+
+        :param data: DataFrame with index Time (UTC, hours) and the bronkolommen,
+                     hours may be missing
+        :return DataFrame with one column per feature, index as data
+    """
+    if len(data) == 0:
+        return pd.DataFrame(columns=[spec.naam for spec in specs], index=data.index, dtype=float)
+
+    # On a regular grid of hours a shift of n rows is n hours
+    grid = pd.date_range(data.index.min(), data.index.max(), freq="h", name=data.index.name)
+    regular = data.reindex(grid)
+
+    result = pd.DataFrame(
+        {spec.naam: FUNCTIES[spec.functie](regular, spec) for spec in specs}, index=grid
+    )
+    return result.reindex(data.index)
+
+
+def bijwerken(conn, data, start=None, specs=FEATURES):
+    """
+        Features for new rows of the dataset: the history they need is
+        read from the dataset, so only the new rows are computed
+
+        :param data: new rows, DataFrame with index Time (UTC) and the bronkolommen
+        :param start: first new hour, None: data is the whole dataset
+        :return DataFrame with the features of the rows of data
+    """
+    if start is None or len(data) == 0:
+        return bereken(data, specs)
+
+    historie = inlezen.dataset(
+        conn, start=start - terugkijken(specs), end=start, columns=bronkolommen(specs)
+    )
+    basis = pd.concat([historie, data[bronkolommen(specs)]])
+    return bereken(basis, specs).reindex(data.index)
+
+
+def voor_voorspelling(conn, voorspelling, specs=FEATURES):
+    """
+        Features for the forecast: the history before the forecast comes
+        from the dataset, columns missing in the forecast (energy) are empty
+
+        :param voorspelling: DataFrame with index Time (UTC)
+        :return DataFrame with the features, index as voorspelling
+    """
+    start = voorspelling.index.min()
+    historie = inlezen.dataset(
+        conn, start=start - terugkijken(specs), end=start, columns=bronkolommen(specs)
+    )
+    data = pd.concat([historie, voorspelling.reindex(columns=bronkolommen(specs))])
+    return bereken(data, specs).reindex(voorspelling.index)
+
+
+if __name__ == "__main__":
+    print("\n\nThe features.py is directly called, not supposed to do so...\n\n")
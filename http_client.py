@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+
+"""
+    Shared HTTP client for SolarEdge and KNMI
+    - Keeps connections alive between calls (one pool per host)
+    - Retries 429 and 5xx responses with exponential backoff and jitter
+    - Keeps latency and retry counters per endpoint
+    - Optional on-disk cache, revalidated with ETag/If-Modified-Since
+"""
+
+import logging
+import codecs
+import configparser
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# Default settings, can be overruled in section [HTTP] of config.ini
+TIMEOUT_CONNECT = 5
+TIMEOUT_READ = 60
+RETRIES = 5
+BACKOFF = 0.5
+BACKOFF_MAX = 30.0
+POOL_SIZE = 4
+CACHE_DIR = ".http_cache"
+
+# Connection pool size per host
+POOL_SIZES = {
+    "monitoringapi.solaredge.com": 3,
+    "www.daggegevens.knmi.nl": 4,
+    "cdn.knmi.nl": 4,
+}
+
+# Responses worth trying again
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    def __init__(
+        self,
+        timeout=(TIMEOUT_CONNECT, TIMEOUT_READ),
+        retries=RETRIES,
+        backoff=BACKOFF,
+        backoff_max=BACKOFF_MAX,
+        pool_size=POOL_SIZE,
+        pool_sizes=None,
+        cache_dir=CACHE_DIR,
+    ):
+        logger.debug("Init HttpClient")
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.pool_sizes = POOL_SIZES if pool_sizes is None else pool_sizes
+        self.cache_dir = cache_dir
+
+        self.session = requests.Session()
+        self._mounted = set()
+        self._lock = threading.Lock()
+
+        # Counters per endpoint
+        self.stats = {}
+
+
+    def _mount(self, url):
+        """
+            Gives each host its own connection pool, sized from pool_sizes
+        """
+        parts = urlsplit(url)
+        prefix = f"{parts.scheme}://{parts.netloc}"
+
+        with self._lock:
+            if prefix in self._mounted:
+                return
+            size = self.pool_sizes.get(parts.hostname, self.pool_size)
+            logger.debug(f"Connection pool for {prefix}: {size}")
+            self.session.mount(
+                prefix, HTTPAdapter(pool_connections=1, pool_maxsize=size)
+            )
+            self._mounted.add(prefix)
+
+
+    @staticmethod
+    def endpoint(url):
+        """
+            Name of the endpoint for the statistics,
+            numbers in the path (e.g. the site_id) are left out
+        """
+        parts = urlsplit(url)
+        path = re.sub(r"/\d+(?=/|$)", "/{id}", parts.path)
+        return f"{parts.netloc}{path}"
+
+
+    def _record(self, endpoint, elapsed=0.0, retry=False, error=False, cached=False):
+        with self._lock:
+            stats = self.stats.setdefault(
+                endpoint,
+                {"calls": 0, "retries": 0, "errors": 0, "time": 0.0, "max_time": 0.0, "cached": 0},
+            )
+            if cached:
+                stats["cached"] += 1
+            elif retry:
+                stats["retries"] += 1
+            elif error:
+                stats["errors"] += 1
+            else:
+                stats["calls"] += 1
+                stats["time"] += elapsed
+                stats["max_time"] = max(stats["max_time"], elapsed)
+
+
+    def _wait(self, attempt, response=None):
+        """
+            Time to wait before the next attempt,
+            uses Retry-After if the server sends one
+        """
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return min(float(response.headers["Retry-After"]), self.backoff_max)
+            except ValueError:
+                pass
+
+        # Exponential backoff with "full jitter"
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+
+    def get(self, url, params=None, before_request=None, **kwargs):
+        """
+            GET request, retries on 429/5xx and connection problems
+            before_request is called before every attempt (retries included),
+            e.g. to take a token of a rate limiter
+            Returns the (last) response
+        """
+        self._mount(url)
+        endpoint = self.endpoint(url)
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        while True:
+            if before_request is not None:
+                before_request()
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    self._record(endpoint, error=True)
+                    raise
+                logger.warning(f"{endpoint}: {e}, retrying...")
+                r = None
+            else:
+                self._record(endpoint, time.perf_counter() - start)
+                if r.status_code not in RETRY_STATUS or attempt >= self.retries:
+                    return r
+                logger.warning(f"{endpoint}: status {r.status_code}, retrying...")
+
+            self._record(endpoint, retry=True)
+            time.sleep(self._wait(attempt, r))
+            attempt += 1
+
+
+    def _cache_path(self, url):
+        """
+            File name in the cache for url, without extension
+        """
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+
+
+    def get_cached(self, url, params=None, **kwargs):
+        """
+            GET request through the on-disk cache. A cached response is
+            revalidated (ETag/If-Modified-Since), a 304 is answered from disk.
+
+            Returns a CachedResponse, .changed tells whether the body differs
+            from the last one the caller marked as processed
+        """
+        url = requests.Request("GET", url, params=params).prepare().url
+        path = self._cache_path(url)
+
+        meta = None
+        if os.path.exists(path + ".json") and os.path.exists(path + ".body"):
+            with open(path + ".json") as f:
+                meta = json.load(f)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        r = self.get(url, headers=headers, **kwargs)
+
+        if r.status_code == 304 and meta is not None:
+            self._record(self.endpoint(url), cached=True)
+            logger.debug(f"{self.endpoint(url)}: not modified")
+            with open(path + ".body", "rb") as f:
+                content = f.read()
+            return CachedResponse(self, url, meta, content)
+
+        r.raise_for_status()
+        content = r.content
+        digest = hashlib.sha256(content).hexdigest()
+
+        # Servers without validators: same body is also unchanged
+        processed = meta is not None and meta.get("processed") and meta.get("sha256") == digest
+        meta = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "sha256": digest,
+            "processed": bool(processed),
+        }
+
+        # Replace the files atomically, another thread or process may read them
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + ".body.tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".body.tmp", path + ".body")
+        self._save_meta(path, meta)
+
+        return CachedResponse(self, url, meta, content)
+
+
+    def _save_meta(self, path, meta):
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+
+    def log_stats(self):
+        """
+            Shows the counters per endpoint
+        """
+        with self._lock:
+            stats = dict(self.stats)
+
+        for endpoint, item in sorted(stats.items()):
+            mean = item["time"] / item["calls"] if item["calls"] else 0
+            logger.info(
+                f'{endpoint}: {item["calls"]} calls, {item["retries"]} retries, '
+                f'{item["errors"]} errors, {item["cached"]} not modified, '
+                f'mean {mean:.2f}s, max {item["max_time"]:.2f}s'
+            )
+
+
+class CachedResponse:
+    """
+        Response from the cache, with the parts of requests.Response
+        that are used (content, headers, json())
+    """
+
+    status_code = 200
+
+    def __init__(self, client, url, meta, content):
+        self._client = client
+        self.url = url
+        self.content = content
+        self.headers = {
+            name: value
+            for name, value in (("ETag", meta["etag"]), ("Last-Modified", meta["last_modified"]))
+            if value
+        }
+        self.changed = not meta["processed"]
+        self._meta = meta
+
+
+    def json(self):
+        return json.loads(self.content)
+
+
+    def raise_for_status(self):
+        pass
+
+
+    def mark_processed(self):
+        """
+            The caller has stored this body, the next get_cached of the
+            same body is reported as unchanged
+        """
+        if not self._meta["processed"]:
+            self._meta["processed"] = True
+            self._client._save_meta(self._client._cache_path(self.url), self._meta)
+
+
+def client_from_config(filename="config.ini"):
+    """
+        Builds a HttpClient with the settings from section [HTTP]
+    """
+    config = configparser.ConfigParser()
+    config.read(filename)
+
+    if "HTTP" not in config:
+        return HttpClient()
+
+    section = config["HTTP"]
+    return HttpClient(
+        timeout=(
+            section.getfloat("timeout_connect", TIMEOUT_CONNECT),
+            section.getfloat("timeout_read", TIMEOUT_READ),
+        ),
+        retries=section.getint("retries", RETRIES),
+        backoff=section.getfloat("backoff", BACKOFF),
+        backoff_max=section.getfloat("backoff_max", BACKOFF_MAX),
+        pool_size=section.getint("pool_size", POOL_SIZE),
+        cache_dir=section.get("cache_dir", CACHE_DIR),
+    )
+
+
+# One client for the whole process, so connections are shared
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = client_from_config()
+        return _client
+
+
+def set_client(client):
+    """
+        Replace the shared client, e.g. with one pointing to a stub server
+    """
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def get(url, params=None, **kwargs):
+    return get_client().get(url, params=params, **kwargs)
+
+
+def get_cached(url, params=None, **kwargs):
+    return get_client().get_cached(url, params=params, **kwargs)
+
+
+def log_stats():
+    get_client().log_stats()
+
+
+def iter_json_array(response, chunk_size=64 * 1024):
+    """
+        Yields the objects of a JSON array one by one while the response
+        streams in (request with stream=True), the full body is never in memory
+        Raises ValueError when the body is not a JSON array or ends before
+        the closing "]" (e.g. a dropped connection)
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    buffer = ""
+    started = False
+
+    for chunk in response.iter_content(chunk_size):
+        buffer += text.decode(chunk)
+        pos = 0
+        while True:
+            # Skip whitespace and separators between the objects
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Response is not a JSON array")
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Object not complete yet, wait for the next chunk
+                break
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    if not started:
+        raise ValueError("Response is not a JSON array")
+    raise ValueError("Truncated JSON array")
+
+
+if __name__ == "__main__":
+    print("\n\nThe http_client.py is directly called, not supposed to do so...\n\n")
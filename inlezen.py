@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+    Readers for the history in the database, used by build_dataset and the notebooks
+    - Period (start <= Time < end) and columns are selected in SQL, on the
+      indexed epoch columns
+    - Times are decoded from epoch seconds at once, the result has a
+      DatetimeIndex "Time" in UTC
+    - With chunk_days an iterator of DataFrames is returned, one per period
+      of chunk_days, for histories which don't fit in memory
+"""
+
+import logging
+
+import pandas as pd
+
+import locaties
+import ophalen_weer
+import tijdas
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+def _bounds(conn, sql, params, start, end):
+    """
+        start/end as epoch seconds, missing bounds from the table
+    """
+    if start is None or end is None:
+        first, last = conn.execute(sql, params).fetchone()
+        if first is None:
+            return None, None
+        if start is None:
+            start = first
+        if end is None:
+            end = last + 1
+    return tijdas.naar_epoch(start), tijdas.naar_epoch(end)
+
+
+def _in_chunks(reader, conn, bounds, chunk_days, **kwargs):
+    start, end = bounds
+    if start is None:
+        return
+    for window_start, window_end in tijdas.vensters(start, end, chunk_days):
+        yield reader(conn, start=window_start, end=window_end, **kwargs)
+
+
+def solaredge(conn, site_id=None, start=None, end=None, chunk_days=None):
+    """
+        Energy per quarter of an hour of one site, or summed over all sites
+
+        :return DataFrame with column energy, index Time (UTC)
+    """
+    logger.debug("Inlezen gegevens SolarEdge")
+
+    if chunk_days is not None:
+        sql, params = "SELECT MIN(epoch), MAX(epoch) FROM solaredge_history", ()
+        if site_id is not None:
+            sql, params = sql + " WHERE site_id = ?", (site_id,)
+        bounds = _bounds(conn, sql, params, start, end)
+        return _in_chunks(solaredge, conn, bounds, chunk_days, site_id=site_id)
+
+    where, params = [], []
+    if site_id is not None:
+        where.append("site_id = ?")
+        params.append(site_id)
+    if start is not None:
+        where.append("epoch >= ?")
+        params.append(tijdas.naar_epoch(start))
+    if end is not None:
+        where.append("epoch < ?")
+        params.append(tijdas.naar_epoch(end))
+    where = f"WHERE {' AND '.join(where)} " if where else ""
+
+    # Van één site of opgeteld over alle sites
+    energy = "energy" if site_id is not None else "SUM(energy) AS energy"
+    group = "GROUP BY epoch " if site_id is None else ""
+    data = pd.read_sql(
+        f"SELECT epoch, {energy} FROM solaredge_history {where}{group}ORDER BY epoch",
+        conn,
+        params=params,
+    )
+
+    data.index = tijdas.naar_index(data.pop("epoch"))
+    return data
+
+
+def solaredge_uur(conn, site_id=None, start=None, end=None):
+    """
+        Energy per hour of one site, or summed over all sites,
+        from table solaredge_hourly (rollups)
+
+        :return DataFrame with column energy, index Time (UTC, start of the hour)
+    """
+    where, params = [], []
+    if site_id is not None:
+        where.append("site_id = ?")
+        params.append(site_id)
+    if start is not None:
+        where.append("epoch >= ?")
+        params.append(tijdas.naar_epoch(start))
+    if end is not None:
+        where.append("epoch < ?")
+        params.append(tijdas.naar_epoch(end))
+    where = f"WHERE {' AND '.join(where)} " if where else ""
+
+    data = pd.read_sql(
+        f"SELECT epoch, SUM(energy) AS energy FROM solaredge_hourly {where}GROUP BY epoch ORDER BY epoch",
+        conn,
+        params=params,
+    )
+
+    data.index = tijdas.naar_index(data.pop("epoch"))
+    return data
+
+
+def solaredge_totaal(conn, per="dag", site_id=None):
+    """
+        Energy per local day ("YYYY-MM-DD") or month ("YYYY-MM") of one site,
+        or summed over all sites, from the rollup tables
+
+        :param per: "dag" or "maand"
+        :return DataFrame with column energy, index dag or maand
+    """
+    table = {"dag": "solaredge_daily", "maand": "solaredge_monthly"}[per]
+    where, params = ("WHERE site_id = ? ", (site_id,)) if site_id is not None else ("", ())
+    return pd.read_sql(
+        f"SELECT {per}, SUM(energy) AS energy FROM {table} {where}GROUP BY {per} ORDER BY {per}",
+        conn,
+        params=params,
+        index_col=per,
+    )
+
+
+def dataset(conn, start=None, end=None, columns=None):
+    """
+        Rows of table dataset (build_dataset), start <= Time < end
+
+        :param columns: list of columns (default all)
+        :return DataFrame with index Time (UTC)
+    """
+    kolommen = "*" if columns is None else ", ".join(f'"{name}"' for name in ["epoch", *columns])
+
+    where, params = [], []
+    if start is not None:
+        where.append("epoch >= ?")
+        params.append(tijdas.naar_epoch(start))
+    if end is not None:
+        where.append("epoch < ?")
+        params.append(tijdas.naar_epoch(end))
+    where = f"WHERE {' AND '.join(where)} " if where else ""
+
+    data = pd.read_sql(f"SELECT {kolommen} FROM dataset {where}ORDER BY epoch", conn, params=params)
+    data.index = tijdas.naar_index(data.pop("epoch"))
+    if "Time" in data.columns:
+        data.drop(columns="Time", inplace=True)
+    return data
+
+
+def weer(conn, site_id=None, start=None, end=None, columns=None, chunk_days=None):
+    """
+        Weather at the location of the site, blended from the nearest stations
+        (ophalen_weer.interpoleren_weer). T is converted to °C.
+
+        :param columns: KNMI variables (default ophalen_weer.VARIABLES)
+        :return DataFrame with the variables, index Time (UTC, start of the hour)
+    """
+    logger.debug("Inlezen gegevens weer")
+
+    if columns is None:
+        columns = list(ophalen_weer.VARIABLES)
+
+    if chunk_days is not None:
+        bounds = _bounds(conn, "SELECT MIN(epoch), MAX(epoch) FROM knmi_history", (), start, end)
+        return _in_chunks(weer, conn, bounds, chunk_days, site_id=site_id, columns=columns)
+
+    latitude, longitude = locaties.get_location(site_id)
+    data = ophalen_weer.interpoleren_weer(
+        conn, latitude, longitude, columns, start=start, end=end
+    )
+
+    data.index = tijdas.naar_index(data.pop("epoch"))
+
+    # De temperatuur staat in 0.1°C, deze wordt nu door 10 gedeeld om de
+    # goede temperatuur te krijgen
+    if "T" in data.columns:
+        data["T"] = data["T"] / 10
+
+    return data
+
+
+if __name__ == "__main__":
+    print("\n\nThe inlezen.py is directly called, not supposed to do so...\n\n")
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+"""
+    Locations of the sites
+    From config.ini: section [Locatie] for the default location and
+    optional sections [Site <site_id>] for each site:
+
+        [Locatie]
+        latitude = 51.2
+        longitude = 6
+
+        [Site 1234567]
+        latitude = 52.1
+        longitude = 5.2
+"""
+
+import configparser
+import logging
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# Default location, used before it was set in config.ini
+LATITUDE = 51.2
+LONGITUDE = 6
+
+
+def get_location(site_id=None, filename="config.ini"):
+    """
+        Location of site_id, or the default location
+
+        returns (latitude, longitude)
+    """
+    config = configparser.ConfigParser()
+    config.read(filename)
+
+    for section in (f"Site {site_id}", "Locatie"):
+        if section in config and "latitude" in config[section]:
+            return (
+                config[section].getfloat("latitude"),
+                config[section].getfloat("longitude"),
+            )
+
+    logger.debug(f"No location for site {site_id} in {filename}, using default")
+    return LATITUDE, LONGITUDE
+
+
+def get_locations(site_ids, filename="config.ini"):
+    """
+        returns dict site_id -> (latitude, longitude)
+    """
+    return {site_id: get_location(site_id, filename) for site_id in site_ids}
+
+
+if __name__ == "__main__":
+    print("\n\nThe locaties.py is directly called, not supposed to do so...\n\n")
@@ -9,24 +9,37 @@
 import coloredlogs, logging
 import configparser
 import solaredge_api as se
-import sqlite3
+import solaredge_plan
+import sync_planner
+import rate_limiter
+import storage
+import rollups
+import hashlib
 import datetime
 import dateutil
-import time
+import concurrent.futures
+import http_client
+import tijdas
 
 
 # Start logger
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
 
+# SolarEdge allows at most 3 concurrent requests from one source
+MAX_WORKERS = 3
+
+DATABASE = storage.DATABASE
+
 
 def start_solaredge_api():
     """
     Start the solaredge api
     Loads the API KEY from config.ini
-    Checks and determines the siteId to use
+    Checks and determines the siteIds to use,
+    site_id in config.ini can hold several ids: "1234, 5678"
 
-    returns: reference to SolarEdge
+    returns: list of SolarEdge, one per site
     """
 
     # Use a config file to store the API KEY (so it's not hardwired into the code)
@@ -55,189 +68,360 @@ def start_solaredge_api():
     else:
         logger.info("Site id exists in configfile")
 
+    # The amount of requests per day is limited per API key,
+    # this limiter is shared by all processes and sites using the database
+    limiter = start_rate_limiter(config["SolarEdge"]["api_key"])
+
     # Initiate the SolarEdge class, the API key is mandatory
-    # If there's a site_id, use it. Otherwise query the site_id
+    solaredge = se.SolarEdge(config["SolarEdge"]["api_key"], rate_limiter=limiter)
+
+    # If there are site_ids, use them. Otherwise query all site_ids of the key
     if "site_id" in config["SolarEdge"]:
-        # Init WITH site_id
-        solaredge = se.SolarEdge(
-            config["SolarEdge"]["api_key"], config["SolarEdge"]["site_id"]
-        )
+        site_ids = [
+            site_id.strip()
+            for site_id in config["SolarEdge"]["site_id"].split(",")
+            if site_id.strip() != ""
+        ]
     else:
-        # Init WITHOUT site_id
-        solaredge = se.SolarEdge(config["SolarEdge"]["api_key"])
-
         # Get the available site_id(s) from the API key
-        solaredge.select_site_id()
+        site_ids = solaredge.get_site_ids()
 
-        # Store site_id for next run
-        config["SolarEdge"]["site_id"] = solaredge.SITE_ID
+        # Store site_ids for next run
+        config["SolarEdge"]["site_id"] = ", ".join(site_ids)
 
         with open("config.ini", "w") as configfile:
             config.write(configfile)
 
-    return solaredge
+    logger.info(f"Using site id(s): {', '.join(site_ids)}")
+
+    return [solaredge.for_site(site_id) for site_id in site_ids]
+
+
+def start_rate_limiter(api_key):
+    """
+    Rate limiter for the SolarEdge API key, stored in the database
+    The key itself is not stored, only a hash of it
+
+    returns rate_limiter.RateLimiter
+    """
+    name = "solaredge:" + hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+    limiter = rate_limiter.RateLimiter(
+        DATABASE,
+        name,
+        se.SolarEdge.MAX_REQUESTS,
+        rate=se.SolarEdge.REQUESTS_PER_SECOND,
+        capacity=se.SolarEdge.REQUESTS_PER_SECOND,
+        warn_at=se.SolarEdge.WARN_REQUESTS,
+    )
+
+    # Move the counters of the old solaredge_connections table into the limiter
+    conn = storage.connect(DATABASE)
+    tables = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'solaredge_connections';"
+    ).fetchall()
+    if len(tables) == 1:
+        logger.info("Moving solaredge_connections into the rate limiter")
+        with conn:
+            conn.execute(
+                """INSERT OR IGNORE INTO rate_limiter_quota
+                    SELECT ?, DATE(datum), amount FROM solaredge_connections;
+                """,
+                (name,),
+            )
+            conn.execute("DROP TABLE solaredge_connections;")
+    conn.close()
+
+    return limiter
 
 
-def prepare_tables(conn):
+def prepare_tables(conn, site_id=None):
     """
     Creates tables for data (if not existing) on conn
+    A solaredge_history without site_id (one site only) is converted,
+    its rows are assigned to site_id
 
     returns None
     """
-    logger.debug("Create table for connections-per-day")
-    sql = """CREATE TABLE IF NOT EXISTS solaredge_connections ( 
-                datum DATETIME PRIMARY KEY NOT NULL, 
-                amount INT NOT NULL );
-            """
-    conn.execute(sql)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(solaredge_history);")]
+    if len(columns) > 0 and "site_id" not in columns:
+        logger.info(f"Adding site_id {site_id} to solaredge history")
+        conn.execute("BEGIN;")
+        conn.execute("ALTER TABLE solaredge_history RENAME TO solaredge_history_old;")
 
     logger.debug("Create table for solaredge history")
     sql = """CREATE TABLE IF NOT EXISTS solaredge_history (
-                tijdstip DATETIME PRIMARY KEY NOT NULL,
-                energy FLOAT );
+                site_id TEXT NOT NULL,
+                tijdstip DATETIME NOT NULL,
+                epoch INTEGER NOT NULL,
+                energy FLOAT,
+                PRIMARY KEY (site_id, epoch) );
             """
     conn.execute(sql)
 
+    if len(columns) > 0 and "site_id" not in columns:
+        rows = conn.execute("SELECT tijdstip, energy FROM solaredge_history_old;").fetchall()
+        conn.executemany(
+            """INSERT OR REPLACE INTO solaredge_history (site_id, tijdstip, epoch, energy)
+                VALUES (?, ?, ?, ?);
+            """,
+            (
+                (site_id, tijdstip, epoch, energy)
+                for (tijdstip, energy), epoch in zip(
+                    rows,
+                    (tijdas.lokaal_naar_epoch(dateutil.parser.parse(row[0])) for row in rows),
+                )
+                if epoch is not None
+            ),
+        )
+        conn.execute("DROP TABLE solaredge_history_old;")
     conn.commit()
 
+    # Older tables are keyed on the local time: the repeated hour at the end of
+    # daylight saving time was stored only once. Rebuilt with key (site_id, epoch)
+    table = storage.table_columns(conn, "solaredge_history")
+    if [name for name, _, key in table if key] != ["site_id", "epoch"]:
+        if "epoch" not in [name for name, _, _ in table]:
+            conn.execute("ALTER TABLE solaredge_history ADD COLUMN epoch INTEGER;")
+        rows = conn.execute("SELECT rowid, tijdstip FROM solaredge_history;").fetchall()
+        logger.info(f"Converting {len(rows)} rows of solaredge history to epoch seconds")
+
+        epochs = [
+            (tijdas.lokaal_naar_epoch(dateutil.parser.parse(tijdstip)), rowid)
+            for rowid, tijdstip in rows
+        ]
+        conn.executemany("UPDATE solaredge_history SET epoch = ? WHERE rowid = ?;", epochs)
+
+        # Times which don't exist (start of daylight saving time)
+        conn.execute("DELETE FROM solaredge_history WHERE epoch IS NULL;")
+        conn.commit()
 
-def get_amount_of_connections(conn):
-    """
-    Get the amount of requests to the SolarEdge API for today
-    from conn
-    """
-    logger.debug("Getting the amount of requests for today")
-    sql = "SELECT amount FROM solaredge_connections WHERE datum = DATE('now');"
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    result = cursor.fetchall()
-
-    # Check result, act accordingly. Expects empty list or list with 1 item
-    if len(result) == 0:
-        logger.debug("No requests for today")
-        return 0
-    elif len(result) == 1:
-        amount = result[0][0]
-        logger.debug(f"Amount requests for today: {amount}")
-        return amount
-    else:
-        # Should not happen, keep it here as failsafe
-        logger.critical("More results returned than expected, exiting...")
-        print(result)
-        exit(-1)
-
+        storage.rebuild_table(
+            conn,
+            "solaredge_history",
+            {"site_id": "TEXT", "tijdstip": "DATETIME", "epoch": "INTEGER", "energy": "FLOAT"},
+            ["site_id", "epoch"],
+        )
 
-def save_amount_of_connections(conn, n):
-    """
-    Saves the amount of requests to the database
-    to conn
-    """
-    logger.debug(f"Saving the amount of requests ({n}) for today")
-    sql = f"INSERT OR REPLACE INTO solaredge_connections VALUES ( DATE('now'), '{n}' );"
-    conn.execute(sql)
+    # Readers select on epoch (all sites), present days are counted per site
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS solaredge_history_epoch ON solaredge_history (epoch);"
+    )
+    conn.execute(
+        """CREATE INDEX IF NOT EXISTS solaredge_history_site_tijdstip
+            ON solaredge_history (site_id, tijdstip);"""
+    )
     conn.commit()
 
+    # Fetch state per period
+    sync_planner.prepare_tables(conn)
 
-def get_last_date(conn):
-    """
-    Get the latest date with information
-    from conn
-    else return None
-    """
-    logger.debug("Fetching the latest date from database")
-    sql = "SELECT tijdstip FROM solaredge_history ORDER BY tijdstip DESC LIMIT 1"
-    cursor = conn.cursor()
-    cursor.execute(sql)
-    result = cursor.fetchall()
-
-    # Check result, act accordingly. Expects empty list or list with 1 item
-    if len(result) == 0:
-        logger.debug("No dates found in database")
-        return None
-    elif len(result) == 1:
-        return dateutil.parser.parse(result[0][0])
-    else:
-        logger.critical("More results returned than expected, exiting...")
-        print(result)
-        exit(-1)
+    # Totals per hour, day and month
+    rollups.prepare_tables(conn)
 
 
-def fetch_all_data(solaredge, conn):
+def production_to_records(site_id, data, periods=None):
     """
-    Fetch data from SolarEdge
-    Store in database
+    Convert the values from SolarEdge into database records
+    Values without data (None) are left out. A bulk call spans the periods
+    of all its sites, with periods only the days missing for this site are kept.
 
-    Loop over each month since (beginning of time)
-    until yesterday
+    :param periods: list of (start, stop) dates (inclusive), None: all days
+    returns list of (site_id, tijdstip, epoch, energie)
     """
-    # Determine where to start with fetching data
-    # - Check last date from database
-    #   - No date --> starting date from API
-    #   - Date --> starting date from database
-
-    last_date = get_last_date(conn)
-    if last_date is None:
-        # solaredge returns a datetime, convert into date
-        start_date = solaredge.get_start_date().date()
-    else:
-        logger.debug(f"Last date in database: {last_date}")
-
-        # Round date to whole day, add one day extra
-        # Should result in e.g. 30-09-2019 --> 01-10-2019
-        start_date = datetime.date(
-            last_date.year, last_date.month, last_date.day
-        ) + datetime.timedelta(days=1)
-
-    logger.info(f"Starting data import from: {start_date}")
-
-    # Start looping over months
-    # logger.warning(f'start_date: {type(start_date)}')
-    # logger.warning(f'date: {type(datetime.date.today() - datetime.timedelta(days=1))}')
-    while start_date <= (datetime.date.today() - datetime.timedelta(days=1)):
-        logger.info("")
-
-        # Extract last-day-of-month from start date (e.g: 16-09-2019: 01-09-2019 -> 30-09-2019)
-        start_month = datetime.date(start_date.year, start_date.month, 1)
-        stop_date = start_month + dateutil.relativedelta.relativedelta(
-            months=1, days=-1
-        )
+    # data is a list of dicts {'date': '2019-09-30 23:00:00', 'value': None}, where
+    # value is either None, or a number. Dates are local time, in order
+    tijdstippen = [dateutil.parser.parse(item["date"]) for item in data]
+    epochs = tijdas.lokale_reeks_naar_epoch(tijdstippen)
 
-        # Catch running until now
-        if stop_date > datetime.date.today():
-            stop_date = datetime.date.today() - datetime.timedelta(days=1)
+    records = []
+    for item, tijdstip, epoch in zip(data, tijdstippen, epochs):
+        # Time in the skipped hour (start of daylight saving time)
+        if epoch is None:
+            continue
+
+        # No data (e.g. before the site started transmitting)
+        if item["value"] is None:
+            continue
+
+        if periods is not None and not any(
+            start <= tijdstip.date() <= stop for start, stop in periods
+        ):
+            continue
+
+        records.append((site_id, tijdstip, epoch, int(item["value"])))
+
+    return records
+
+
+def get_missing_periods(sites, conn):
+    """
+    Determine which periods to fetch for each site (list of SolarEdge):
+    all days without data since the first date of the site until yesterday
 
-        logger.info(f"Stopping data import on: {stop_date}")
+    returns dict site_id -> list of (start, stop) dates
+    """
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
 
-        # Get one month of data
-        data = solaredge.get_production(start_date, stop_date)
-        records = []
-        for item in data:
-            # data is a list of dicts {'date': '2019-09-30 23:00:00', 'value': None}, where
-            # value is either None, or a number
+    # Days with data per site, answered from index (site_id, tijdstip)
+    sql = """SELECT DISTINCT substr(tijdstip, 1, 10) FROM solaredge_history
+                WHERE site_id = ?;"""
+    present = {
+        solaredge.SITE_ID: sync_planner.present_days(conn, sql, (solaredge.SITE_ID,))
+        for solaredge in sites
+    }
 
-            tijdstip = dateutil.parser.parse(item["date"])
-            if item["value"] != None:
-                energie = int(item["value"])
+    # Determine where to start with fetching data
+    # - No date --> starting date from API
+    # - Date --> first date from database
+    start_dates = {
+        site_id: min(days) for site_id, days in present.items() if len(days) > 0
+    }
+
+    # New sites: ask the starting dates from the API, in one (bulk) call
+    new_sites = [solaredge.SITE_ID for solaredge in sites if solaredge.SITE_ID not in start_dates]
+    if len(new_sites) > 0:
+        for site_id, period in sites[0].get_data_periods(new_sites).items():
+            if period is None:
+                logger.warning(f"Site {site_id} is not transmitting, skipping")
             else:
-                energie = 0
+                # solaredge returns a datetime, convert into date
+                start_dates[site_id] = period[0].date()
 
-            records.append((tijdstip, energie))
+    missing = {}
+    for site_id, start_date in start_dates.items():
+        missing[site_id] = sync_planner.plan(
+            conn, "solaredge", site_id, present[site_id], start_date, yesterday
+        )
+        if len(missing[site_id]) > 0:
+            logger.info(
+                f"Site {site_id}: {len(missing[site_id])} missing period(s), "
+                f"starting from: {missing[site_id][0][0]}"
+            )
 
-        # Send data to database
-        cursor = conn.cursor()
-        cursor.executemany("INSERT INTO solaredge_history VALUES (?, ?);", records)
-        logging.info(f"Entered {cursor.rowcount} records into database")
+    return missing
 
-        conn.commit()
 
-        # Cool down and contemplate
-        time.sleep(1)
+def fetch_all_data(sites, conn, max_workers=MAX_WORKERS, time_unit="QUARTER_OF_AN_HOUR"):
+    """
+    Fetch data from SolarEdge for all sites (list of SolarEdge)
+    Store in database
 
-        # Set for next month
-        start_date = stop_date + datetime.timedelta(days=1)
-    else:
-        # Ja, er kan een _else_ in een _while_ loop
+    The missing periods of all sites are covered with the fewest calls
+    (solaredge_plan): each call spans the longest period allowed and
+    holds all sites missing that period (bulk). The calls share one pool
+    of max_workers. The periods of a site are stored in date order,
+    so the last date of each site is always a valid point to resume from.
+    """
+    missing = get_missing_periods(sites, conn)
+    calls = solaredge_plan.plan_calls(
+        missing, se.SolarEdge.MAX_PERIOD[time_unit], se.SolarEdge.MAX_BULK_SITES
+    )
+
+    if len(calls) == 0:
         logger.info("No data needs to be fetched (anymore)")
+        return
+
+    # Stay within the amount of requests for today (shared by all sites
+    # of the API key), the remaining calls are made on the next run
+    requests_left = sites[0].requests_left()
+    if len(calls) > requests_left:
+        logger.warning(
+            f"Only {requests_left} of {len(calls)} calls can be made today"
+        )
+        calls = calls[:requests_left]
+    else:
+        logger.info(f"Fetching {len(missing)} site(s) in {len(calls)} call(s)")
+
+    # Per site: calls in date order, and the results waiting for an earlier call
+    pending = {site_id: [] for site_id in missing}
+    for call in calls:
+        for site_id in call.site_ids:
+            pending[site_id].append(call)
+            for start, stop in solaredge_plan.clip(missing[site_id], call.start, call.stop):
+                sync_planner.mark_interval(conn, "solaredge", site_id, start, stop, "pending")
+    conn.commit()
+    done = {site_id: {} for site_id in missing}
+
+    # Do the calls in parallel, but store them per site in date order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                sites[0].get_bulk_production, call.site_ids, call.start, call.stop, time_unit
+            ): call
+            for call in calls
+        }
+
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                call = futures[future]
+                try:
+                    result = future.result()
+                except rate_limiter.QuotaExceeded as e:
+                    # Another process used up the requests, continue on the next run.
+                    # Later periods of these sites can't be stored before this one
+                    logger.warning(f"{e}, continuing from {call.start} on the next run")
+                    for site_id in call.site_ids:
+                        pending[site_id] = []
+                    continue
+
+                for site_id in call.site_ids:
+                    done[site_id][call] = result.get(site_id, [])
+
+                    # Store all periods of this site which are next in line
+                    while len(pending[site_id]) > 0 and pending[site_id][0] in done[site_id]:
+                        next_call = pending[site_id].pop(0)
+
+                        # Only the days this site is missing, the call can
+                        # span periods of other sites
+                        periods = solaredge_plan.clip(
+                            missing[site_id], next_call.start, next_call.stop
+                        )
+                        records = production_to_records(
+                            site_id, done[site_id].pop(next_call), periods
+                        )
+
+                        # Fetch state, days without data are not asked for every run
+                        days = {record[1].date() for record in records}
+                        for start, stop in periods:
+                            sync_planner.mark_interval(
+                                conn, "solaredge", site_id, start, stop,
+                                "done", sum(start <= record[1].date() <= stop for record in records)
+                            )
+                            for empty_start, empty_stop in sync_planner.missing_intervals(
+                                days, start, stop
+                            ):
+                                sync_planner.mark_interval(
+                                    conn, "solaredge", site_id, empty_start, empty_stop, "done", 0
+                                )
+
+                        # Send data to database together with the fetch state and
+                        # the totals of the days in this call, in one transaction
+                        try:
+                            changes = storage.upsert(
+                                conn,
+                                "solaredge_history",
+                                ["site_id", "tijdstip", "epoch", "energy"],
+                                records,
+                                ["site_id", "epoch"],
+                                commit=False,
+                            )
+                            if changes > 0:
+                                for start, stop in periods:
+                                    rollups.update(conn, site_id, start, stop, commit=False)
+                            conn.commit()
+                        except BaseException:
+                            conn.rollback()
+                            raise
+                        logger.info(
+                            f"Site {site_id}: entered {changes} records "
+                            f"({next_call.start} - {next_call.stop}) into database"
+                        )
+        except BaseException:
+            # Don't start any new requests when something went wrong
+            for future in futures:
+                future.cancel()
+            raise
 
     logger.info("Data fetching complete!")
 
@@ -245,30 +429,29 @@ def fetch_all_data(solaredge, conn):
 def get_data():
     # First, start the solaredge api:
     # - Opens config.ini and reads the API key
-    # - The site_id is automatically determined and saved
-    solaredge = start_solaredge_api()
+    # - The site_ids are automatically determined and saved
+    sites = start_solaredge_api()
 
     # Open database
     # Separate from class SolarEdge, to provide easy switching of databases
     # SQLite3 for now, keep data local (will be pushed into github repo)
-    conn = sqlite3.connect("database.db")
+    conn = storage.connect(DATABASE)
 
     # Prepare tables in database, only needed for first run
-    prepare_tables(conn)
-
-    # Database is connected, restore amount of connections for today
-    solaredge.request_count = get_amount_of_connections(conn)
+    prepare_tables(conn, sites[0].SITE_ID)
 
     # Fetch all data from solaredge, store in database
-    fetch_all_data(solaredge, conn)
+    fetch_all_data(sites, conn)
 
     # Clean up
-    # Save amount of requests for today
-    save_amount_of_connections(conn, solaredge.request_count)
+    requests_made = sum(solaredge.request_count for solaredge in sites)
+    logger.info(f"Requests made: {requests_made}, left for today: {sites[0].requests_left()}")
 
     # Close connection to database
     conn.close()
 
+    http_client.log_stats()
+
 
 # Wrap get_data into __main__, so this function can be
 # called through an "import ophalen_solaredge"
@@ -3,12 +3,23 @@
 """
     Fetch historical weather data
     Source: KNMI 
+
+    Usage: python ophalen_weer.py [--narrow]
+    --narrow first drops the columns of variables which are not used
+    anymore from knmi_history (see versmallen)
 """
 
+import argparse
 import coloredlogs, logging
-import requests
-import sqlite3
-import datetime, dateutil
+import configparser
+import concurrent.futures
+import http_client
+import locaties
+import sync_planner
+import storage
+import tijdas
+import datetime
+import numpy as np
 import pandas as pd
 
 
@@ -16,6 +27,89 @@ import pandas as pd
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
 
+KNMI_URL = "https://www.daggegevens.knmi.nl/klimatologie/uurgegevens"
+
+# Weather station Ell, the nearest station for the default location
+STATION = 377
+
+# KNMI weather stations: code -> (name, latitude, longitude)
+STATIONS = {
+    209: ("IJmond", 52.465, 4.518),
+    210: ("Valkenburg Zh", 52.171, 4.430),
+    215: ("Voorschoten", 52.141, 4.437),
+    225: ("IJmuiden", 52.463, 4.555),
+    235: ("De Kooy", 52.928, 4.781),
+    240: ("Schiphol", 52.318, 4.790),
+    242: ("Vlieland", 53.241, 4.921),
+    248: ("Wijdenes", 52.634, 5.174),
+    249: ("Berkhout", 52.644, 4.979),
+    251: ("Hoorn Terschelling", 53.392, 5.346),
+    257: ("Wijk aan Zee", 52.506, 4.603),
+    258: ("Houtribdijk", 52.649, 5.401),
+    260: ("De Bilt", 52.100, 5.180),
+    265: ("Soesterberg", 52.130, 5.274),
+    267: ("Stavoren", 52.898, 5.384),
+    269: ("Lelystad", 52.458, 5.520),
+    270: ("Leeuwarden", 53.224, 5.752),
+    273: ("Marknesse", 52.703, 5.888),
+    275: ("Deelen", 52.056, 5.873),
+    277: ("Lauwersoog", 53.413, 6.200),
+    278: ("Heino", 52.435, 6.259),
+    279: ("Hoogeveen", 52.750, 6.574),
+    280: ("Eelde", 53.125, 6.585),
+    283: ("Hupsel", 52.069, 6.657),
+    285: ("Huibertgat", 53.575, 6.399),
+    286: ("Nieuw Beerta", 53.196, 7.150),
+    290: ("Twenthe", 52.274, 6.891),
+    308: ("Cadzand", 51.381, 3.379),
+    310: ("Vlissingen", 51.442, 3.596),
+    311: ("Hoofdplaat", 51.379, 3.672),
+    312: ("Oosterschelde", 51.768, 3.622),
+    313: ("Vlakte van De Raan", 51.505, 3.242),
+    315: ("Hansweert", 51.447, 3.998),
+    316: ("Schaar", 51.657, 3.694),
+    319: ("Westdorpe", 51.226, 3.861),
+    323: ("Wilhelminadorp", 51.527, 3.884),
+    324: ("Stavenisse", 51.596, 4.006),
+    330: ("Hoek van Holland", 51.992, 4.122),
+    331: ("Tholen", 51.480, 4.193),
+    340: ("Woensdrecht", 51.449, 4.342),
+    343: ("Rotterdam Geulhaven", 51.893, 4.313),
+    344: ("Rotterdam", 51.962, 4.447),
+    348: ("Cabauw", 51.970, 4.926),
+    350: ("Gilze-Rijen", 51.566, 4.936),
+    356: ("Herwijnen", 51.859, 5.146),
+    370: ("Eindhoven", 51.451, 5.377),
+    375: ("Volkel", 51.659, 5.707),
+    377: ("Ell", 51.198, 5.763),
+    380: ("Maastricht", 50.906, 5.762),
+    391: ("Arcen", 51.498, 6.197),
+}
+
+# Amount of stations per site, their weather is blended by inverse distance
+N_STATIONS = 3
+IDW_POWER = 2
+
+# Stations fetched at the same time
+MAX_WORKERS = 4
+
+# Primary key of knmi_history
+KEY = ["station_code", "date", "hour"]
+
+# Variables used by the dataset, with their column name in the dataset:
+# T: temperature (0.1 °C), DR: duration of precipitation (0.1 hour),
+# N: cloud cover (okta)
+KOLOMMEN = {
+    "T": "temperatuur",
+    "DR": "duur_neerslag",
+    "N": "bewolking",
+}
+VARIABLES = list(KOLOMMEN)
+
+# Days per request, and rows per write to the database
+WINDOW_DAYS = 31
+BATCH_ROWS = 24 * 7
+
 
 def get_solaredge_date_range(conn):
     """
@@ -25,101 +119,336 @@ def get_solaredge_date_range(conn):
     """
     logger.info("Getting the dates from solaredge database")
 
-    cursor = conn.cursor()
-
-    sql = "SELECT tijdstip FROM solaredge_history ORDER BY tijdstip ASC LIMIT 1;"
-    cursor.execute(sql)
-    start_date = dateutil.parser.parse(cursor.fetchone()[0])
-
-    sql = "SELECT tijdstip FROM solaredge_history ORDER BY tijdstip DESC LIMIT 1;"
-    cursor.execute(sql)
-    end_date = dateutil.parser.parse(cursor.fetchone()[0])
+    # Answered from the epoch index, the dates are UTC like the KNMI dates
+    sql = "SELECT MIN(epoch), MAX(epoch) FROM solaredge_history;"
+    first, last = conn.execute(sql).fetchone()
+    start_date = datetime.datetime.fromtimestamp(first, datetime.timezone.utc)
+    end_date = datetime.datetime.fromtimestamp(last, datetime.timezone.utc)
 
     logger.debug(f'Found {start_date} and {end_date}')
 
     return start_date, end_date
 
 
-def get_knmi_last_date(conn):
+def get_variables(filename="config.ini"):
     """
-        Gets last date entry in knmi database
-        :param conn: database connection 
-        :return date or None
+        KNMI variables to fetch, from section [KNMI] of config.ini
+        (e.g. "vars = T, DR, N"), default VARIABLES
     """
-    logger.info("Getting the last date from knmi database")
+    config = configparser.ConfigParser()
+    config.read(filename)
 
-    cursor = conn.cursor()
-    sql = "SELECT date FROM knmi_history ORDER BY date DESC LIMIT 1;"
+    if "KNMI" in config and "vars" in config["KNMI"]:
+        return [var.strip() for var in config["KNMI"]["vars"].split(",") if var.strip() != ""]
+    return list(VARIABLES)
 
-    try:
-        cursor.execute(sql)
-    except sqlite3.Error as e:
-        logger.warning(f'Error: no result from database: {e}')
-        return None
 
-    last_date = dateutil.parser.parse(cursor.fetchone()[0])
+def _columns(variables):
+    """
+        Columns of knmi_history with only variables
+    """
+    columns = {"station_code": "INTEGER", "date": "TEXT", "hour": "INTEGER", "epoch": "INTEGER"}
+    columns.update({var: "INTEGER" for var in variables})
+    return columns
 
-    logger.debug(f'Result from knmi database call: {last_date}')
-    
-    return last_date
 
+def prepare_tables(conn, variables=VARIABLES):
+    """
+        Creates knmi_history (if not existing) with only the key and variables,
+        all KNMI hourly values are integers.
 
-def get_data():
-    # Connect to database
-    conn = sqlite3.connect('database.db')
+        Variables added later are added as a column, these are filled
+        for newly fetched days. Columns are not dropped here: variables which
+        are not used anymore keep their values, until versmallen is run.
+        Column epoch (start of the measured hour, epoch seconds) is filled
+        from date and hour.
+        Older tables were written by pandas.to_sql without a primary key,
+        these are rebuilt once with primary key KEY (all columns are kept).
+    """
+    columns = _columns(variables)
 
-    # Get last date from knmi database
-    last_knmi = get_knmi_last_date(conn)
+    if storage.table_exists(conn, "knmi_history"):
+        existing = {column[0] for column in storage.table_columns(conn, "knmi_history")}
 
-    # Get dates from solaredge database
-    first_solar, last_solar = get_solaredge_date_range(conn)
+        if "epoch" not in existing:
+            logger.info("Adding epoch to knmi_history")
+            conn.execute("ALTER TABLE knmi_history ADD COLUMN epoch INTEGER;")
+            conn.execute(
+                """UPDATE knmi_history
+                    SET epoch = CAST(strftime('%s', substr(date, 1, 10)) AS INTEGER) + (hour - 1) * 3600;"""
+            )
+            existing.add("epoch")
+
+        # Variables which are new, as empty columns
+        for var in variables:
+            if var not in existing:
+                logger.info(f"Adding variable {var} to knmi_history")
+                conn.execute(f'ALTER TABLE knmi_history ADD COLUMN "{var}" INTEGER;')
+                existing.add(var)
+        conn.commit()
 
-    # Determine which starting date to use
-    if last_knmi is None:
-        logger.debug('No date from KNMI, using solaredge as starting date')
-        first_date = first_solar
+        # Without primary key: rebuild once, with all columns there are
+        table_columns = storage.table_columns(conn, "knmi_history")
+        if {name for name, _, in_key in table_columns if in_key} != set(KEY):
+            storage.rebuild_table(
+                conn, "knmi_history",
+                {name: sql_type or "INTEGER" for name, sql_type, _ in table_columns}, KEY,
+                order_by="id" if "id" in existing else None,
+            )
     else:
-        logger.debug('KNMI returned a date, using this one as starting date')
-        first_date = last_knmi
+        storage.create_table(conn, "knmi_history", columns, KEY)
 
-    # Convert dates into knmi format
-    start_date = first_date.strftime('%Y%m%d')
-    end_date = last_solar.strftime('%Y%m%d')
+    # Readers select stations and a period
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS knmi_history_epoch ON knmi_history (station_code, epoch);"
+    )
+    conn.commit()
 
-    # Is a fetch needed?
-    if start_date == end_date:
-        logger.info('No data needs to be fetched from KNMI, skipping query...')
-    else:
-        logger.debug(f'Querying KNMI for dates {start_date} to {end_date}')
-
-        # API call to KNMI, just get all data for now.
-        # TODO: Optimize, only request parameters which will be put into model
-        r = requests.get(
-            "https://www.daggegevens.knmi.nl/klimatologie/uurgegevens",
-            params={
-                "start": start_date,
-                "end": end_date,
-                "vars": "ALL",
-                "stns": 377,
-                "fmt": "json",
-            },
-        )
-
-        # Convert the JSON to a DataFrame
-        logger.info('JSON to DataFrame')
-        weather_history = pd.DataFrame.from_dict(r.json())
-
-        # Save to database
-        logger.info('DataFrame to database')
-        weather_history.to_sql('knmi_history', con=conn , if_exists='append',
-                index_label='id')
-
-    # Close connection to database
+    sync_planner.prepare_tables(conn)
+
+
+def versmallen(conn, variables=VARIABLES):
+    """
+        Opt-in migration: rebuilds knmi_history with only the key, epoch and
+        variables, the columns of other variables are dropped and the space
+        is given back (VACUUM).
+
+        :return list of dropped columns
+    """
+    prepare_tables(conn, variables)
+
+    columns = _columns(variables)
+    dropped = [
+        name for name, _, _ in storage.table_columns(conn, "knmi_history") if name not in columns
+    ]
+    if len(dropped) == 0:
+        logger.info("knmi_history has only the used variables")
+        return dropped
+
+    logger.info(f"Dropping {', '.join(dropped)} from knmi_history")
+    storage.rebuild_table(conn, "knmi_history", columns, KEY)
+
+    # The index of the readers went with the old table
+    prepare_tables(conn, variables)
+    return dropped
+
+
+def get_knmi_present_days(conn, station=STATION):
+    """
+        Gets the days with all 24 hours in knmi database
+        :param conn: database connection
+        :return set of dates
+    """
+    logger.info("Getting the days from knmi database")
+
+    if not storage.table_exists(conn, "knmi_history"):
+        logger.warning('No knmi history in database yet')
+        return set()
+
+    # Answered from the primary key index (station_code, date, hour)
+    sql = """SELECT substr(date, 1, 10) FROM knmi_history WHERE station_code = ?
+                GROUP BY substr(date, 1, 10) HAVING COUNT(*) >= 24;"""
+    return sync_planner.present_days(conn, sql, (station,))
+
+
+def fetch_interval(conn, start, stop, station=STATION, variables=VARIABLES):
+    """
+        Fetch the days start..stop (dates) from KNMI, store in knmi database
+        The response is read as a stream and written in batches of BATCH_ROWS,
+        so memory use doesn't depend on the length of the interval.
+        Rows which are already there are updated, not doubled
+    """
+    logger.debug(f'Querying KNMI for dates {start} to {stop}')
+
+    # API call to KNMI, only the variables which are put into the model
+    r = http_client.get(
+        KNMI_URL,
+        params={
+            "start": start.strftime('%Y%m%d') + "01",
+            "end": stop.strftime('%Y%m%d') + "24",
+            "vars": ":".join(variables),
+            "stns": station,
+            "fmt": "json",
+        },
+        stream=True,
+    )
+    r.raise_for_status()
+
+    rows = 0
+    days = set()
+    with r:
+        batch = []
+        for item in http_client.iter_json_array(r):
+            batch.append(item)
+            if len(batch) >= BATCH_ROWS:
+                rows += store_batch(conn, batch, days, variables)
+                batch = []
+        if len(batch) > 0:
+            rows += store_batch(conn, batch, days, variables)
+
+    # Fetch state, days without data are not asked for again
+    logger.info(f'Stored {rows} rows ({start} - {stop})')
+    sync_planner.mark_interval(conn, "knmi", station, start, stop, "done", rows)
+    for empty_start, empty_stop in sync_planner.missing_intervals(days, start, stop):
+        sync_planner.mark_interval(conn, "knmi", station, empty_start, empty_stop, "done", 0)
     conn.commit()
+
+
+def store_batch(conn, batch, days, variables=VARIABLES):
+    """
+        Saves a batch of KNMI rows (list of dicts) to the database,
+        adds the days of the rows to days
+
+        :return amount of rows
+    """
+    # Convert the JSON to a DataFrame, nullable integers (KNMI leaves out missing values)
+    weather_history = pd.DataFrame.from_records(batch, columns=KEY + list(variables))
+    weather_history[variables] = weather_history[variables].astype("Int64")
+    weather_history.insert(
+        len(KEY), "epoch",
+        tijdas.datum_uur_naar_epoch(weather_history["date"], weather_history["hour"]),
+    )
+    days.update(datetime.date.fromisoformat(d[:10]) for d in weather_history["date"])
+
+    # Save to database, the dataset build recomputes from the first hour written
+    storage.mark_low_water(conn, "knmi_history", weather_history["epoch"].min())
+    storage.upsert_frame(conn, 'knmi_history', weather_history, KEY, index=False)
+
+    return len(weather_history)
+
+
+def nearest_stations(latitude, longitude, n=N_STATIONS):
+    """
+        The n stations nearest to latitude, longitude
+
+        :return list of station codes, numpy array of distances [km]
+    """
+    codes = np.array(list(STATIONS))
+    coordinates = np.radians([STATIONS[code][1:] for code in codes])
+    lat, lon = np.radians(latitude), np.radians(longitude)
+
+    # Haversine distance
+    a = (
+        np.sin((coordinates[:, 0] - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(coordinates[:, 0]) * np.sin((coordinates[:, 1] - lon) / 2) ** 2
+    )
+    distances = 2 * 6371 * np.arcsin(np.sqrt(a))
+
+    nearest = np.argsort(distances)[:n]
+    return [int(code) for code in codes[nearest]], distances[nearest]
+
+
+def fetch_station(station, first_date, last_date, variables=VARIABLES):
+    """
+        Fetch the missing days first_date..last_date of one station,
+        runs in its own thread with its own database connection
+    """
+    conn = storage.connect()
+    try:
+        present = get_knmi_present_days(conn, station)
+
+        # Which days are missing (including holes), fetch only these
+        intervals = sync_planner.plan(conn, "knmi", station, present, first_date, last_date)
+        if len(intervals) == 0:
+            logger.info(f'Station {station}: no data needs to be fetched from KNMI')
+
+        # Long intervals are fetched in windows, each window is stored when it's done
+        for start, stop in sync_planner.split(intervals, WINDOW_DAYS):
+            fetch_interval(conn, start, stop, station, variables)
+    finally:
+        conn.close()
+
+
+def interpoleren_weer(
+    conn, latitude, longitude, variables=VARIABLES, n=N_STATIONS, power=IDW_POWER,
+    start=None, end=None,
+):
+    """
+        Weather at latitude, longitude: inverse distance weighted average
+        of the n nearest stations. Missing values of a station are left out
+        of the average. With start/end only start <= time < end.
+
+        :return DataFrame with epoch and variables
+    """
+    stations, distances = nearest_stations(latitude, longitude, n)
+    logger.debug(f"Weather at ({latitude}, {longitude}) from stations {stations}")
+
+    # Answered from index (station_code, epoch)
+    kolommen = ", ".join(f'"{var}"' for var in ["station_code", "epoch", *variables])
+    sql = f"SELECT {kolommen} FROM knmi_history WHERE station_code IN ({', '.join('?' * len(stations))})"
+    params = list(stations)
+    if start is not None:
+        sql += " AND epoch >= ?"
+        params.append(tijdas.naar_epoch(start))
+    if end is not None:
+        sql += " AND epoch < ?"
+        params.append(tijdas.naar_epoch(end))
+    data = pd.read_sql(sql, conn, params=params)
+
+    # One row per hour, per variable one column per station: [hour, variable, station]
+    wide = data.set_index(["epoch", "station_code"])[variables].unstack("station_code")
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([variables, stations]))
+    values = wide.to_numpy(dtype=float).reshape(len(wide), len(variables), len(stations))
+
+    # Weights 1/d^p, a station on the location itself gets all the weight
+    weights = 1 / np.maximum(distances, 0.01) ** power
+    present = ~np.isnan(values)
+    total = np.where(present, values, 0) @ weights
+    weight = present @ weights
+    blended = np.divide(total, weight, out=np.full_like(total, np.nan), where=weight > 0)
+
+    return pd.DataFrame(blended, index=wide.index, columns=variables).reset_index()
+
+
+def get_data(variables=None, n_stations=N_STATIONS):
+    # Variables to fetch, from config.ini if not given
+    if variables is None:
+        variables = get_variables()
+
+    # Connect to database
+    conn = storage.connect()
+    prepare_tables(conn, variables)
+
+    # Get dates from solaredge database
+    first_solar, last_solar = get_solaredge_date_range(conn)
+
+    # Nearest stations of all sites, sites close to each other share stations
+    site_ids = [row[0] for row in conn.execute("SELECT DISTINCT site_id FROM solaredge_history;")]
     conn.close()
 
+    stations = set()
+    for site_id, (latitude, longitude) in locaties.get_locations(site_ids).items():
+        nearest, _ = nearest_stations(latitude, longitude, n_stations)
+        logger.info(f"Site {site_id}: stations {', '.join(STATIONS[code][0] for code in nearest)}")
+        stations.update(nearest)
+
+    # Fetch the stations at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                fetch_station, station, first_solar.date(), last_solar.date(), variables
+            )
+            for station in sorted(stations)
+        ]
+        for future in futures:
+            future.result()
+
+    http_client.log_stats()
+
 
 # Wrap get_data into __main__, so this function can be
 # called through an "import ophalen_weer"
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fetch the KNMI history")
+    parser.add_argument(
+        "--narrow", action="store_true",
+        help="drop the columns of variables which are not used anymore",
+    )
+    args = parser.parse_args()
+
+    if args.narrow:
+        conn = storage.connect()
+        versmallen(conn, get_variables())
+        conn.close()
+
     get_data()
@@ -3,133 +3,295 @@
 """
     Fetch weather forecast
     Source: KNMI
+
+    Every forecast is kept in knmi_forecast_history, per issue time (uitgiftetijd)
+    with the valid times as offset in minutes. View knmi_forecast shows the latest.
 """
 
-import requests
+import concurrent.futures
+import datetime
+import email.utils
+import http_client
+import numpy as np
 import pandas as pd
 import coloredlogs, logging
-import sqlite3
+import storage
+import tijdas
+
+# orjson is sneller, maar niet verplicht
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    import json
+
+    json_loads = json.loads
 
 
 # Start logger
 logger = logging.getLogger(__name__)
 coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
 
+# Expertpluim van het KNMI, station 380 (Maastricht)
+IPLUIM_URL = "https://cdn.knmi.nl/knmi/json/page/weer/waarschuwingen_verwachtingen/ensemble/iPluim"
+URL_TEMPERATUUR = f"{IPLUIM_URL}/380_Expert_99999.json"
+URL_NEERSLAG = f"{IPLUIM_URL}/380_Expert_13021.json"
+URL_BEWOLKING = f"{IPLUIM_URL}/380_Expert_20010.json"
+
+# Kolommen van de voorspelling: kolom -> (bestand, {serie: gewicht}).
+# Een kolom is de gewogen som van zijn series. Een nieuwe variabele is een
+# extra regel hier, bestanden die meerdere kolommen leveren worden één keer opgehaald.
+SERIES = {
+    "temperatuur": (URL_TEMPERATUUR, {"Hoge resolutie": 1}),
+    "neerslag": (URL_NEERSLAG, {"Hoge resolutie": 1}),
+    # Bewolking in okta: de percentages per klasse maal 0, 2, 4, 6 of 8 okta
+    "bewolking": (
+        URL_BEWOLKING,
+        {
+            "Onbewolkt": 0 / 100,
+            "Licht bewolkt": 2 / 100,
+            "Half bewolkt": 4 / 100,
+            "Zwaar bewolkt": 6 / 100,
+            "Geheel bewolkt": 8 / 100,
+        },
+    ),
+}
+
+# Alle voorspellingen, sleutel (issue_time, valid_offset)
+HISTORY_TABLE = "knmi_forecast_history"
+VIEW = "knmi_forecast"
+
+
+def parse_series(content, names):
+    """
+        Leest de series names uit een iPluim bestand, het bestand wordt
+        één keer gedecodeerd
+
+        :param content: body van het bestand (bytes)
+        :param names: set van serienamen
+        :return dict serienaam -> (tijden [ms] als int64 array, waarden als float array)
+    """
+    result = {}
+    for serie in json_loads(content)["series"]:
+        name = serie.get("name")
+        if name in names:
+            # Punten zijn [tijd, waarde], None wordt NaN
+            data = np.asarray(serie["data"], dtype=float).reshape(-1, 2)
+            result[name] = (data[:, 0].astype(np.int64), data[:, 1])
+
+    ontbreekt = set(names) - result.keys()
+    if len(ontbreekt) > 0:
+        raise ValueError(f"Series {', '.join(sorted(ontbreekt))} niet gevonden")
+
+    return result
+
+
+def parse_voorspelling(contents, series=SERIES):
+    """
+        Zet de bestanden om naar één DataFrame met een kolom per
+        variabele uit series, zonder merges: alle series worden op één
+        gezamenlijke tijdas gezet. Alleen tijdstippen die in alle series
+        voorkomen blijven over.
+
+        :param contents: dict url -> body
+        :return DataFrame met index Tijdstip (UTC)
+    """
+    names = {}
+    for url, weights in series.values():
+        names.setdefault(url, set()).update(weights)
+    parsed = {url: parse_series(contents[url], wanted) for url, wanted in names.items()}
+
+    # Gezamenlijke tijdas
+    alle = [times for per_url in parsed.values() for times, _ in per_url.values()]
+    times = np.unique(np.concatenate(alle))
+    aanwezig = np.zeros(len(times), dtype=int)
+    for serie_times in alle:
+        aanwezig[np.searchsorted(times, np.unique(serie_times))] += 1
+
+    values = np.zeros((len(times), len(series)))
+    for column, (url, weights) in enumerate(series.values()):
+        for name, weight in weights.items():
+            serie_times, serie_values = parsed[url][name]
+            values[np.searchsorted(times, serie_times), column] += weight * serie_values
+
+    keep = aanwezig == len(alle)
+    return pd.DataFrame(
+        values[keep],
+        index=pd.DatetimeIndex(pd.to_datetime(times[keep], unit="ms"), name="Tijdstip"),
+        columns=list(series),
+    )
+
+
+def ophalen_alles(series=SERIES):
+    """
+        Haalt alle bestanden tegelijk op, via de HTTP cache
+
+        :return dict url -> response
+    """
+    urls = list(dict.fromkeys(url for url, _ in series.values()))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return dict(zip(urls, executor.map(http_client.get_cached, urls)))
+
+
+def get_issue_time(responses):
+    """
+        Uitgiftetijd van de voorspelling: de laatste Last-Modified van de
+        series, zonder Last-Modified het huidige tijdstip (UTC)
+    """
+    tijden = [
+        email.utils.parsedate_to_datetime(r.headers["Last-Modified"])
+        for r in responses.values()
+        if "Last-Modified" in r.headers
+    ]
+    if len(tijden) > 0:
+        issue_time = max(tijden).astimezone(datetime.timezone.utc)
+    else:
+        issue_time = datetime.datetime.now(datetime.timezone.utc)
+
+    # Op de minuut, zodat uitgiftetijd + offset (minuten) precies de geldige tijd is
+    return issue_time.replace(tzinfo=None, second=0, microsecond=0)
+
+
+def prepare_tables(conn, columns):
+    """
+        Maakt de tabel met alle voorspellingen en de view met de laatste
+        voorspelling (als die nog niet bestaan)
+
+        :param columns: kolommen van de voorspelling
+    """
+    # De oude knmi_forecast tabel bevat alleen de laatste voorspelling,
+    # zonder uitgiftetijd. Eenmalig weggooien, de view komt ervoor in de plaats
+    if storage.table_exists(conn, VIEW):
+        logger.info(f"Tabel {VIEW} wordt vervangen door een view op {HISTORY_TABLE}")
+        conn.execute(f"DROP TABLE {VIEW};")
+
+    storage.create_table(
+        conn,
+        HISTORY_TABLE,
+        {"issue_time": "DATETIME", "valid_offset": "INTEGER", **{name: "REAL" for name in columns}},
+        ["issue_time", "valid_offset"],
+    )
+
+    # Nieuwe series krijgen een eigen kolom
+    bestaand = [name for name, _, _ in storage.table_columns(conn, HISTORY_TABLE)]
+    nieuw = [name for name in columns if name not in bestaand]
+    for name in nieuw:
+        conn.execute(f'ALTER TABLE {HISTORY_TABLE} ADD COLUMN "{name}" REAL;')
+
+    # View opnieuw maken als de definitie verandert (nieuwe kolommen)
+    view_sql = f"""CREATE VIEW {VIEW} AS
+                SELECT {_kolommen(conn)}
+                FROM {HISTORY_TABLE}
+                WHERE issue_time = (SELECT MAX(issue_time) FROM {HISTORY_TABLE})"""
+    view = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?;", (VIEW,)
+    ).fetchone()
+    if view is None or view[0] != view_sql:
+        conn.execute(f"DROP VIEW IF EXISTS {VIEW};")
+        conn.execute(view_sql)
+
+    conn.commit()
 
-def ophalen_temperatuur():
-    # Temperatuur ophalen van KNMI
-    logger.debug("Ophalen temperatuur")
-
-    url = 'https://cdn.knmi.nl/knmi/json/page/weer/waarschuwingen_verwachtingen/ensemble/iPluim/380_Expert_99999.json'
-    r = requests.get(url)
-
-    # Selecteer de serie "Hoge resolutie" uit alle aangeleverde gegevens
-    for serie in r.json()["series"]:
-        if "name" in serie.keys() and serie["name"] == "Hoge resolutie":
-            temperatuur = pd.DataFrame(serie["data"], columns=["time", "temperatuur"])
-
-    # Omzetten van unix timestamp [ms] naar datetime
-    temperatuur["Tijdstip"] = pd.to_datetime(temperatuur["time"], unit="ms")
-
-    # Tijdstippen als index gebruiken
-    temperatuur.set_index("Tijdstip", inplace=True)
-    temperatuur.drop("time", inplace=True, axis=1)
-
-    return temperatuur
-
-
-def ophalen_neerslag():
-    ## Neerslag
-    logger.debug("Ophalen neerslag")
-    url = 'https://cdn.knmi.nl/knmi/json/page/weer/waarschuwingen_verwachtingen/ensemble/iPluim/380_Expert_13021.json'
-    r = requests.get(url)
-    import pprint
-    for serie in r.json()["series"]:
-        if "name" in serie.keys() and serie["name"] == "Hoge resolutie":
-            neerslag = pd.DataFrame(serie["data"], columns=["time", "neerslag"])
-            
-    # Omzetten van unix timestamp [ms] naar datetime
-    neerslag["Tijdstip"] = pd.to_datetime(neerslag["time"], unit="ms")
-
-    # Tijdstippen naar index
-    neerslag.set_index("Tijdstip", inplace=True)
-    neerslag.drop("time", inplace=True, axis=1)
-
-    return neerslag
-
-
-def ophalen_bewolking():
-    ## Bewolking
-    logger.debug("Ophalen bewolking")
-    url = 'https://cdn.knmi.nl/knmi/json/page/weer/waarschuwingen_verwachtingen/ensemble/iPluim/380_Expert_20010.json'
-    r = requests.get(url)
-
-    # Bewolking wordt anders teruggegeven, meerdere kolommen
-    for serie in r.json()["series"]:
-        if serie["name"] == "Onbewolkt": 
-            onbewolkt = pd.DataFrame(serie["data"], columns=["time", "onbewolkt"])
-        if serie["name"] == "Licht bewolkt": 
-            licht_bewolkt = pd.DataFrame(serie["data"], columns=["time", "licht_bewolkt"])
-        if serie["name"] == "Half bewolkt": 
-            half_bewolkt = pd.DataFrame(serie["data"], columns=["time", "half_bewolkt"])
-        if serie["name"] == "Zwaar bewolkt": 
-            zwaar_bewolkt = pd.DataFrame(serie["data"], columns=["time", "zwaar_bewolkt"])
-        if serie["name"] == "Geheel bewolkt": 
-            geheel_bewolkt = pd.DataFrame(serie["data"], columns=["time", "geheel_bewolkt"])
-
-    # Alle typen bewolking in één dataframe stoppen    
-    # Stap voor stap mergen van kolommen    
-    bewolking = onbewolkt.merge(licht_bewolkt, on="time")
-    bewolking = bewolking.merge(half_bewolkt, on="time")
-    bewolking = bewolking.merge(zwaar_bewolkt, on="time")
-    bewolking = bewolking.merge(geheel_bewolkt, on="time")
-
-    # Controle uitvoeren, som = 100%
-    # --> Ja klopt, ter referentie hier laten staan
-    #bewolking["controle"] = bewolking["onbewolkt"] + bewolking["licht_bewolkt"] + bewolking["half_bewolkt"] + bewolking["zwaar_bewolkt"] + bewolking["geheel_bewolkt"]
-
-    # Omzetten timestamp naar tijd (index)
-    bewolking["Tijdstip"] = pd.to_datetime(bewolking["time"], unit="ms")
-    bewolking.set_index("Tijdstip", inplace=True)
-    bewolking.drop("time", inplace=True, axis=1)
-
-    # Bewolking score uitrekenen
-    # Nul keer iets is altijd nul, maar voor leesbaarheid laten staan
-    bewolking["bewolking"] = (0 * bewolking["onbewolkt"] + 
-                                2 * bewolking["licht_bewolkt"] + 
-                                4 * bewolking["half_bewolkt"] + 
-                                6 * bewolking["zwaar_bewolkt"] + 
-                                8 * bewolking["geheel_bewolkt"])/100
-
-    return bewolking
-
-
-def get_data():
+
+def _kolommen(conn):
+    """
+        Kolommen van een voorspelling: Tijdstip (tekst, UTC), epoch (seconden)
+        en de variabelen
+    """
+    variabelen = ", ".join(
+        f'"{name}"' for name, _, _ in storage.table_columns(conn, HISTORY_TABLE)
+        if name not in ("issue_time", "valid_offset")
+    )
+    return (
+        "datetime(issue_time, valid_offset || ' minutes') AS Tijdstip, "
+        "CAST(strftime('%s', issue_time) AS INTEGER) + valid_offset * 60 AS epoch, "
+        f"{variabelen}"
+    )
+
+
+def opslaan(conn, voorspelling, issue_time):
+    """
+        Voegt een voorspelling toe aan de historie, in één transactie:
+        lezers zien de vorige of de nieuwe voorspelling, nooit een halve
+
+        :param voorspelling: DataFrame met index Tijdstip (UTC)
+        :param issue_time: uitgiftetijd (UTC)
+        :return aantal opgeslagen rijen
+    """
+    prepare_tables(conn, list(voorspelling.columns))
+
+    # Tijdstippen als verschil met de uitgiftetijd in minuten, kleine integers.
+    # De uitgiftetijd op de minuut, anders valt iedere tijd net voor het hele uur
+    issue_time = issue_time.replace(second=0, microsecond=0)
+    data = voorspelling.copy()
+    data.insert(0, "valid_offset", (data.index - issue_time) // pd.Timedelta(minutes=1))
+    data.insert(0, "issue_time", issue_time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    columns, rows = storage.frame_rows(data, index=False)
+    rows = storage.upsert(conn, HISTORY_TABLE, columns, rows, ["issue_time", "valid_offset"])
+    logger.info(f"Voorspelling van {issue_time} opgeslagen: {rows} rijen")
+    return rows
+
+
+def voorspelling_op(conn, moment=None):
+    """
+        De laatste voorspelling die op moment (UTC) bekend was,
+        voor backtesten. Zonder moment de laatste voorspelling.
+
+        :return DataFrame met index Tijdstip (UTC)
+    """
+    if moment is None:
+        moment = datetime.datetime.utcnow()
+
+    # Beide stappen gaan via de primary key (issue_time, valid_offset)
+    sql = f"""SELECT {_kolommen(conn)}
+              FROM {HISTORY_TABLE}
+              WHERE issue_time = (SELECT MAX(issue_time) FROM {HISTORY_TABLE} WHERE issue_time <= ?)
+              ORDER BY valid_offset;"""
+    data = pd.read_sql(sql, conn, params=(moment.strftime("%Y-%m-%d %H:%M:%S"),))
+
+    # Tijdstippen uit de epoch, in UTC
+    data.drop(columns="Tijdstip", inplace=True)
+    data.index = tijdas.naar_index(data.pop("epoch"), name="Tijdstip")
+    return data
+
+
+def get_data(force=False):
+    """
+        Haalt de weersvoorspelling op en slaat die op.
+        Als geen enkele serie is gewijzigd sinds de vorige keer wordt
+        niets verwerkt (tenzij force), zo kan er vaak gepolld worden.
+
+        :return True als de voorspelling is opgeslagen
+    """
     ## Combineren van de weersvoorspelling
     logger.info("Ophalen weersvoorspelling")
-    temperatuur = ophalen_temperatuur()
-    neerslag = ophalen_neerslag()
-    bewolking = ophalen_bewolking()
+    responses = ophalen_alles()
+
+    if not force and not any(r.changed for r in responses.values()):
+        logger.info("Weersvoorspelling is niet gewijzigd")
+        http_client.log_stats()
+        return False
 
-    # De temperatuur, neerslag en bewolking worden in één dataframe opgeslagen
+    # Alle series in één keer in één dataframe
     logger.info("Weersvoorspelling samenvoegen")
-    voorspelling = temperatuur.merge(neerslag, left_index=True, right_index=True)
-    voorspelling = voorspelling.merge(bewolking["bewolking"], left_index=True, right_index=True)
+    voorspelling = parse_voorspelling({url: r.content for url, r in responses.items()})
 
     # Voorspelling opslaan in een SQLite3 database
     logger.info("Weersvoorspelling opslaan in de database")
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
+    conn = storage.connect()
+    opslaan(conn, voorspelling, get_issue_time(responses))
 
-    # Vorige voorspelling wissen
-    cursor.execute("DROP TABLE IF EXISTS knmi_forecast")
+    # Afsluiten
+    conn.close()
 
-    # Voorspelling opslaan in database
-    voorspelling.to_sql("knmi_forecast", conn)
+    # Pas na het opslaan als verwerkt markeren, na een crash wordt het opnieuw gedaan
+    for r in responses.values():
+        r.mark_processed()
 
-    # Opslaan en afsluiten
-    conn.commit()
-    conn.close()
+    http_client.log_stats()
+    return True
 
 
 # Wrap get_data into __main__, so this function can be
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+"""
+    Runs the steps of a pipeline in the order of their dependencies
+    - A step starts as soon as the steps it depends on (na) are done,
+      steps that don't depend on each other run at the same time (threads)
+    - A step with an invoer function is skipped when its inputs didn't
+      change since it last ran: invoer(conn) gives a signature of the
+      inputs (e.g. last epoch and count of the tables it reads), which is
+      kept in table pipeline_state. invoer None: the step always runs.
+    - When a step fails, the steps that depend on it are not run
+    - At the end the wall time of every step is shown, with the total and
+      the critical path (the longest chain of dependent steps)
+"""
+
+import concurrent.futures
+import datetime
+import json
+import logging
+import time
+from collections import namedtuple
+
+import storage
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+TABLE = "pipeline_state"
+
+# One step: name, function (no arguments), names of the steps it runs after,
+# function conn -> signature of the inputs (JSON serialisable) or None
+Stap = namedtuple("Stap", ["naam", "functie", "na", "invoer"], defaults=[(), None])
+
+# Result of a step: "klaar", "ongewijzigd", "fout" or "niet gestart"
+Resultaat = namedtuple("Resultaat", ["status", "start", "seconden", "fout"])
+MISLUKT = ("fout", "niet gestart")
+
+
+def prepare_tables(conn):
+    storage.create_table(
+        conn,
+        TABLE,
+        {"stap": "TEXT", "invoer": "TEXT", "klaar": "DATETIME", "seconden": "REAL"},
+        ["stap"],
+    )
+    conn.commit()
+
+
+def _controleren(stappen):
+    """
+        Unique names, known dependencies and no cycles
+    """
+    namen = [stap.naam for stap in stappen]
+    if len(set(namen)) != len(namen):
+        raise ValueError("Names of the steps must be unique")
+    for stap in stappen:
+        onbekend = set(stap.na) - set(namen)
+        if len(onbekend) > 0:
+            raise ValueError(f"Step {stap.naam} runs after unknown steps {', '.join(sorted(onbekend))}")
+
+    # Steps in order of their dependencies, what is left has a cycle
+    gedaan = set()
+    while len(gedaan) < len(namen):
+        klaar = {stap.naam for stap in stappen if stap.naam not in gedaan and set(stap.na) <= gedaan}
+        if len(klaar) == 0:
+            raise ValueError(f"Cycle in the steps {', '.join(sorted(set(namen) - gedaan))}")
+        gedaan |= klaar
+
+
+def _uitvoeren_stap(stap, database, force, start):
+    """
+        Runs one step, unless its inputs didn't change
+
+        :return Resultaat
+    """
+    begin = time.perf_counter()
+    conn = storage.connect(database)
+    try:
+        invoer = None if stap.invoer is None else json.dumps(stap.invoer(conn), sort_keys=True)
+        if not force and invoer is not None:
+            vorige = conn.execute(f"SELECT invoer FROM {TABLE} WHERE stap = ?;", (stap.naam,)).fetchone()
+            if vorige is not None and vorige[0] == invoer:
+                logger.info(f"{stap.naam}: inputs unchanged, skipped")
+                return Resultaat("ongewijzigd", begin - start, time.perf_counter() - begin, None)
+
+        logger.info(f"{stap.naam}: started")
+        stap.functie()
+        seconden = time.perf_counter() - begin
+
+        # Inputs as they were when the step started
+        storage.upsert(
+            conn,
+            TABLE,
+            ["stap", "invoer", "klaar", "seconden"],
+            [(stap.naam, invoer, datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), seconden)],
+            ["stap"],
+        )
+        logger.info(f"{stap.naam}: done in {seconden:.1f} s")
+        return Resultaat("klaar", begin - start, seconden, None)
+    except Exception as e:
+        logger.error(f"{stap.naam}: failed: {e}")
+        return Resultaat("fout", begin - start, time.perf_counter() - begin, e)
+    finally:
+        conn.close()
+
+
+def uitvoeren(stappen, database=storage.DATABASE, force=(), max_workers=None):
+    """
+        Runs the steps, each as soon as the steps it depends on are done
+
+        :param force: names of steps to run even if their inputs didn't change,
+                      True for all steps
+        :return dict name -> Resultaat
+        :raises the error of the first step that failed, after the other
+                steps are done
+    """
+    _controleren(stappen)
+
+    conn = storage.connect(database)
+    prepare_tables(conn)
+    conn.close()
+
+    per_naam = {stap.naam: stap for stap in stappen}
+    resultaten = {}
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(stappen)) as executor:
+        lopend = {}
+
+        def starten():
+            # Steps of which all dependencies are done. After a failure the
+            # steps that depend on it don't start, nor the steps after those
+            gewijzigd = True
+            while gewijzigd:
+                gewijzigd = False
+                for stap in stappen:
+                    if stap.naam in resultaten or stap.naam in lopend.values():
+                        continue
+                    na = [resultaten.get(naam) for naam in stap.na]
+                    if any(r is not None and r.status in MISLUKT for r in na):
+                        logger.warning(f"{stap.naam}: not started, a step it depends on failed")
+                        resultaten[stap.naam] = Resultaat("niet gestart", None, 0.0, None)
+                        gewijzigd = True
+                    elif all(r is not None for r in na):
+                        geforceerd = force is True or stap.naam in force
+                        future = executor.submit(_uitvoeren_stap, stap, database, geforceerd, start)
+                        lopend[future] = stap.naam
+
+        starten()
+        while len(lopend) > 0:
+            done, _ = concurrent.futures.wait(lopend, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                resultaten[lopend.pop(future)] = future.result()
+            starten()
+
+    rapport(per_naam, resultaten, time.perf_counter() - start)
+
+    fouten = [r.fout for r in resultaten.values() if r.fout is not None]
+    if len(fouten) > 0:
+        raise fouten[0]
+    return resultaten
+
+
+def kritiek_pad(stappen, resultaten):
+    """
+        Longest chain of dependent steps, by their time
+
+        :return (seconds, list of names)
+    """
+    pad = {}
+
+    def langste(naam):
+        if naam not in pad:
+            vorige = [langste(na) for na in stappen[naam].na]
+            seconden, namen = max(vorige, default=(0.0, []))
+            pad[naam] = (seconden + resultaten[naam].seconden, namen + [naam])
+        return pad[naam]
+
+    return max((langste(naam) for naam in stappen), default=(0.0, []))
+
+
+def rapport(stappen, resultaten, totaal):
+    """
+        Logs start, wall time and status of every step
+    """
+    logger.info("Step                   start [s]  time [s]  status")
+    for naam in stappen:
+        r = resultaten[naam]
+        begin = "" if r.start is None else f"{r.start:.1f}"
+        logger.info(f"  {naam:<20} {begin:>9} {r.seconden:>9.1f}  {r.status}")
+
+    seconden, pad = kritiek_pad(stappen, resultaten)
+    som = sum(r.seconden for r in resultaten.values())
+    logger.info(
+        f"Total {totaal:.1f} s (sum of the steps {som:.1f} s), "
+        f"critical path {seconden:.1f} s: {' -> '.join(pad)}"
+    )
+
+
+if __name__ == "__main__":
+    print("\n\nThe pijplijn.py is directly called, not supposed to do so...\n\n")
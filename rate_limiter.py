@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+"""
+    Rate limiter for API calls
+    - Token bucket: at most `rate` calls per second, with bursts up to `capacity`
+    - Daily quota: at most `daily_quota` calls per (UTC) day
+
+    The state is kept in the SQLite database and updated in one
+    (immediate) transaction per call, so several threads and processes
+    can share the same limiter without overshooting the quota.
+"""
+
+import logging
+import contextlib
+import datetime
+import sqlite3
+import time
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """
+        The daily quota is spent, try again tomorrow
+    """
+
+
+class RateLimiter:
+    def __init__(self, database, name, daily_quota, rate=1.0, capacity=1, warn_at=None):
+        logger.debug(f"Init RateLimiter {name}")
+
+        self.database = database
+        self.name = name
+        self.daily_quota = daily_quota
+        self.rate = rate
+        self.capacity = capacity
+        self.warn_at = warn_at
+
+        with self._connect() as conn:
+            self.prepare_tables(conn)
+
+
+    def _connect(self):
+        # Short-lived connection per call, so the limiter can be used from any thread.
+        # Autocommit mode, transactions are started explicitly
+        return contextlib.closing(
+            sqlite3.connect(self.database, timeout=60, isolation_level=None)
+        )
+
+
+    @staticmethod
+    def prepare_tables(conn):
+        """
+            Creates tables for the limiter (if not existing) on conn
+        """
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS rate_limiter (
+                    name TEXT PRIMARY KEY NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL );
+            """
+        )
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS rate_limiter_quota (
+                    name TEXT NOT NULL,
+                    datum DATE NOT NULL,
+                    amount INT NOT NULL,
+                    PRIMARY KEY (name, datum) );
+            """
+        )
+
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.utcnow().date().isoformat()
+
+
+    @staticmethod
+    def _seconds_until_tomorrow():
+        now = datetime.datetime.utcnow()
+        tomorrow = datetime.datetime.combine(
+            now.date() + datetime.timedelta(days=1), datetime.time()
+        )
+        return (tomorrow - now).total_seconds()
+
+
+    def used_today(self):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT amount FROM rate_limiter_quota WHERE name = ? AND datum = ?;",
+                (self.name, self._today()),
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+
+    def remaining(self):
+        """
+            Amount of calls left for today
+        """
+        return max(self.daily_quota - self.used_today(), 0)
+
+
+    def _try_acquire(self, n):
+        """
+            One atomic attempt to take n tokens
+
+            returns 0 when taken, else the seconds to wait for enough tokens
+            raises QuotaExceeded when the daily quota is spent
+        """
+        today = self._today()
+
+        with self._connect() as conn:
+            # Lock the database for writing, other processes wait (busy timeout)
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                row = conn.execute(
+                    "SELECT amount FROM rate_limiter_quota WHERE name = ? AND datum = ?;",
+                    (self.name, today),
+                ).fetchone()
+                used = 0 if row is None else row[0]
+
+                if used + n > self.daily_quota:
+                    raise QuotaExceeded(
+                        f"{self.name}: daily quota of {self.daily_quota} calls spent"
+                    )
+
+                # Refill the bucket for the time passed since the last call
+                now = time.time()
+                row = conn.execute(
+                    "SELECT tokens, updated FROM rate_limiter WHERE name = ?;",
+                    (self.name,),
+                ).fetchone()
+                if row is None:
+                    tokens = self.capacity
+                else:
+                    tokens = min(self.capacity, row[0] + (now - row[1]) * self.rate)
+
+                if tokens < n:
+                    return (n - tokens) / self.rate
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limiter VALUES (?, ?, ?);",
+                    (self.name, tokens - n, now),
+                )
+                conn.execute(
+                    """INSERT INTO rate_limiter_quota VALUES (?, ?, ?)
+                        ON CONFLICT (name, datum) DO UPDATE SET amount = amount + excluded.amount;
+                    """,
+                    (self.name, today, n),
+                )
+            finally:
+                conn.execute("COMMIT;")
+
+        if self.warn_at is not None and used + n > self.warn_at:
+            logger.warning(f"{self.name}: {used + n} of {self.daily_quota} calls used today")
+
+        return 0
+
+
+    def acquire(self, n=1, wait_for_quota=False):
+        """
+            Take n tokens, waits until the bucket has enough of them
+
+            When the daily quota is spent QuotaExceeded is raised, unless
+            wait_for_quota is set: then it waits until the next day.
+        """
+        while True:
+            try:
+                wait = self._try_acquire(n)
+            except QuotaExceeded:
+                if not wait_for_quota:
+                    raise
+                wait = self._seconds_until_tomorrow()
+                logger.warning(f"{self.name}: quota spent, waiting {wait:.0f}s")
+
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+
+if __name__ == "__main__":
+    print("\n\nThe rate_limiter.py is directly called, not supposed to do so...\n\n")
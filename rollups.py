@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+"""
+    Totals of solaredge_history per hour, day and month
+    - solaredge_hourly: per site and hour (epoch seconds, UTC, start of the hour)
+    - solaredge_daily: per site and local day ("YYYY-MM-DD")
+    - solaredge_monthly: per site and local month ("YYYY-MM")
+    The totals are updated for the days which are written, from the rows
+    of those days only. Rows written again give the same totals.
+    Changed hours lower the low-water mark of solaredge_hourly, so the
+    dataset build recomputes them (also hours long before its last hour).
+"""
+
+import datetime
+import logging
+
+import storage
+import tijdas
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+TABLES = {
+    "solaredge_hourly": ({"site_id": "TEXT", "epoch": "INTEGER", "energy": "FLOAT"}, ["site_id", "epoch"]),
+    "solaredge_daily": ({"site_id": "TEXT", "dag": "TEXT", "energy": "FLOAT"}, ["site_id", "dag"]),
+    "solaredge_monthly": ({"site_id": "TEXT", "maand": "TEXT", "energy": "FLOAT"}, ["site_id", "maand"]),
+}
+
+
+def prepare_tables(conn):
+    """
+        Creates the tables (if not existing), new tables are filled
+        from the history that is already there
+    """
+    new = [table for table in TABLES if not storage.table_exists(conn, table)]
+    for table, (columns, key) in TABLES.items():
+        storage.create_table(conn, table, columns, key)
+    conn.commit()
+
+    if len(new) > 0:
+        rebuild(conn)
+
+
+def _upsert_select(table, key, select):
+    """
+        INSERT ... SELECT which only updates the totals that changed
+    """
+    return (
+        f"INSERT INTO {table} ({', '.join(key)}, energy) {select} "
+        f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET energy = excluded.energy "
+        f"WHERE energy IS NOT excluded.energy;"
+    )
+
+
+def update(conn, site_id, first_day, last_day, commit=True):
+    """
+        Recomputes the totals of site_id for the local days first_day..last_day
+        (dates, inclusive) and the months they are in, in one transaction.
+        commit=False: in the transaction of the caller, the caller commits.
+    """
+    start = first_day.isoformat()
+    stop = (last_day + datetime.timedelta(days=1)).isoformat()
+    first_month = first_day.strftime("%Y-%m")
+    last_month = last_day.strftime("%Y-%m")
+
+    try:
+        # Local days start on a whole hour, so the hours of these days are complete.
+        # Rows of the days are found with index (site_id, tijdstip)
+        hourly = conn.execute(
+            _upsert_select(
+                "solaredge_hourly",
+                ["site_id", "epoch"],
+                """SELECT site_id, epoch - epoch % 3600, SUM(energy) FROM solaredge_history
+                    WHERE site_id = ? AND tijdstip >= ? AND tijdstip < ?
+                    GROUP BY epoch - epoch % 3600""",
+            ),
+            (site_id, start, stop),
+        )
+        if hourly.rowcount > 0:
+            storage.mark_low_water(
+                conn, "solaredge_hourly",
+                tijdas.lokaal_naar_epoch(datetime.datetime.combine(first_day, datetime.time())),
+            )
+        conn.execute(
+            _upsert_select(
+                "solaredge_daily",
+                ["site_id", "dag"],
+                """SELECT site_id, substr(tijdstip, 1, 10), SUM(energy) FROM solaredge_history
+                    WHERE site_id = ? AND tijdstip >= ? AND tijdstip < ?
+                    GROUP BY substr(tijdstip, 1, 10)""",
+            ),
+            (site_id, start, stop),
+        )
+        # Months from the day totals
+        conn.execute(
+            _upsert_select(
+                "solaredge_monthly",
+                ["site_id", "maand"],
+                """SELECT site_id, substr(dag, 1, 7), SUM(energy) FROM solaredge_daily
+                    WHERE site_id = ? AND dag >= ? AND dag < ?
+                    GROUP BY substr(dag, 1, 7)""",
+            ),
+            (site_id, first_month, last_month + "-99"),
+        )
+        if commit:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def rebuild(conn):
+    """
+        Recomputes all totals from solaredge_history
+    """
+    sql = """SELECT site_id, MIN(substr(tijdstip, 1, 10)), MAX(substr(tijdstip, 1, 10))
+                FROM solaredge_history GROUP BY site_id;"""
+    for site_id, first, last in conn.execute(sql).fetchall():
+        logger.info(f"Site {site_id}: totals per hour, day and month ({first} - {last})")
+        update(
+            conn, site_id, datetime.date.fromisoformat(first), datetime.date.fromisoformat(last)
+        )
+
+
+if __name__ == "__main__":
+    print("\n\nThe rollups.py is directly called, not supposed to do so...\n\n")
@@ -8,8 +8,10 @@
 """
 
 import logging
-import requests
+import threading
+import http_client
 from dateutil.parser import parse
+from dateutil.relativedelta import relativedelta
 
 # Get logger
 logger = logging.getLogger(__name__)
@@ -19,44 +21,81 @@ class SolarEdge:
     SITE_ID = None
     API_LINK = "https://monitoringapi.solaredge.com"
 
-    def __init__(self, API_KEY, SITE_ID=None, request_count=0, start_date=None, end_date=None):
+    # Fair use policy is 300 calls a day, keep some margin
+    WARN_REQUESTS = 250
+    MAX_REQUESTS = 275
+
+    # At most 3 concurrent calls are allowed, keep the pace around that
+    REQUESTS_PER_SECOND = 3
+
+    # Longest period of one energy request per timeUnit, None: no limit
+    MAX_PERIOD = {
+        "QUARTER_OF_AN_HOUR": relativedelta(months=1),
+        "HOUR": relativedelta(months=1),
+        "DAY": relativedelta(years=1),
+        "WEEK": None,
+        "MONTH": None,
+        "YEAR": None,
+    }
+
+    # Maximum amount of site_ids in one bulk request
+    MAX_BULK_SITES = 100
+
+    def __init__(self, API_KEY, SITE_ID=None, request_count=0, start_date=None, end_date=None,
+                 api_link=None, rate_limiter=None):
         logger.debug("Init SolarEdge")
 
+        # Another API_LINK can be given, e.g. for testing against a local server
+        if api_link is not None:
+            self.API_LINK = api_link
+
         self.API_KEY = API_KEY
         self.SITE_ID = SITE_ID
         self.request_count = request_count
         self.start_date = start_date
         self.end_date = end_date
 
+        # Shared (rate_limiter.RateLimiter) limiter for this API key, optional
+        self.rate_limiter = rate_limiter
+
+        # Requests can be sent from several threads at once
+        self._lock = threading.Lock()
+
 
     def _api_call(self, url, params):
         """
             Performs a request to SolarEdge API
             Returns request response
         """
-        # Check amount of requests 
-        self.request_count += 1
-        if self.request_count > 250:
-            logger.warning("Too many requests pending...")
-        if self.request_count > 275:
-            logger.critical("Too many requests, exiting...")
-            exit(-2)
-
-        # Send request to SolarEdge API
-        r = requests.get(url, params=params)
-
-        # Check response code
+        def before_request():
+            # Wait for a free slot, raises rate_limiter.QuotaExceeded
+            # when there are no requests left for today
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            # Count the requests made by this instance
+            with self._lock:
+                self.request_count += 1
+
+        # Send request to SolarEdge API, the http_client retries on 429
+        # and server errors. Every attempt takes a slot of the limiter,
+        # a retry uses the quota as well.
+        r = http_client.get(url, params=params, before_request=before_request)
+
+        # Check response code, leave it to the caller what to do
         if r.status_code != 200:
-            logger.critical(
-                f"Could not get API CALL, error: {r.status_code} exiting..."
-            )
-            exit(-1)
+            logger.critical(f"Could not get API CALL, error: {r.status_code}")
+            r.raise_for_status()
         
         # Return response 
         return r
 
 
-    def select_site_id(self):
+    def get_site_ids(self):
+        """
+            Queries all site_ids available for the API key
+            Returns list of site_ids (as str)
+        """
         logger.debug("Querying the site_id(s)")
         
         # Call API
@@ -64,19 +103,20 @@ class SolarEdge:
         response = r.json()["sites"]
 
         # Collect all site_ids
-        logger.info("Site ids found:")
+        logger.info(f'{response["count"]} site id(s) found:')
         for site in response["site"]:
             logger.info(f'SiteId {site["id"]}: {site["name"]}')
-        
-        if response["count"] == 1:
-            # Only one site, use this one and continue silently
-            logger.info(f'Only one site_id found, using: {response["site"][0]["id"]}')
-            self.SITE_ID = str(response["site"][0]["id"])
-        else:
-            # Multiple sites found, print and exit
-            logger.warning("Multiple sites found")
-            logger.info("Please enter one of the 'site_id' above in section 'SolarEdge'. Exiting...")
-            exit(0)
+
+        return [str(site["id"]) for site in response["site"]]
+
+
+    def for_site(self, site_id):
+        """
+            Returns a SolarEdge for site_id, sharing the API key,
+            link and rate limiter with this one
+        """
+        return SolarEdge(self.API_KEY, str(site_id), api_link=self.API_LINK,
+                         rate_limiter=self.rate_limiter)
 
 
     def get_start_date(self):
@@ -109,16 +149,50 @@ class SolarEdge:
         self.end_date = response["dataPeriod"]["endDate"]
 
 
-    def get_production(self, start_date, stop_date):
+    def requests_left(self):
+        """
+            Returns the amount of requests that can still be made today
+        """
+        if self.rate_limiter is not None:
+            return self.rate_limiter.remaining()
+
+        with self._lock:
+            return max(self.MAX_REQUESTS - self.request_count, 0)
+
+
+    def get_data_periods(self, site_ids):
         """
-            Query SolarEdge API, get QUARTER_OF_AN_HOUR aggregated values from timespan
+            Queries SolarEdge API (bulk) for start and end date of site_ids
+            Returns dict site_id -> (start_date, end_date), None for
+            sites which are not transmitting
+        """
+        logger.debug("Querying dataPeriod (bulk)")
+
+        periods = {}
+        for i in range(0, len(site_ids), self.MAX_BULK_SITES):
+            chunk = ",".join(str(site_id) for site_id in site_ids[i : i + self.MAX_BULK_SITES])
+            r = self._api_call(f"{self.API_LINK}/sites/{chunk}/dataPeriod",
+                                {"api_key": self.API_KEY})
+
+            for item in r.json()["dataPeriod"]["list"]:
+                if item["startDate"] is None:
+                    periods[str(item["id"])] = None
+                else:
+                    periods[str(item["id"])] = (parse(item["startDate"]), parse(item["endDate"]))
+
+        return periods
+
+
+    def get_production(self, start_date, stop_date, time_unit="QUARTER_OF_AN_HOUR"):
+        """
+            Query SolarEdge API, get time_unit aggregated values from timespan
         """
         logger.debug("Querying energy data")
 
         # Send request to SolarEdge API
         r = self._api_call(f"{self.API_LINK}/site/{self.SITE_ID}/energy", 
                             {"api_key": self.API_KEY, 
-                            "timeUnit": "QUARTER_OF_AN_HOUR",
+                            "timeUnit": time_unit,
                             "startDate": start_date.strftime("%Y-%m-%d"), 
                             "endDate": stop_date.strftime("%Y-%m-%d")})
 
@@ -126,5 +200,33 @@ class SolarEdge:
 
         return response["energy"]["values"]
 
+
+    def get_bulk_production(self, site_ids, start_date, stop_date, time_unit="QUARTER_OF_AN_HOUR"):
+        """
+            Query SolarEdge API for (at most MAX_BULK_SITES) site_ids in one call,
+            get time_unit aggregated values from timespan
+            Returns dict site_id -> values
+        """
+        logger.debug("Querying energy data (bulk)")
+
+        # One site, no need for the bulk version
+        if len(site_ids) == 1:
+            url = f"{self.API_LINK}/site/{site_ids[0]}/energy"
+        else:
+            url = f"{self.API_LINK}/sites/{','.join(str(s) for s in site_ids)}/energy"
+
+        # Send request to SolarEdge API
+        r = self._api_call(url,
+                            {"api_key": self.API_KEY,
+                            "timeUnit": time_unit,
+                            "startDate": start_date.strftime("%Y-%m-%d"),
+                            "endDate": stop_date.strftime("%Y-%m-%d")})
+
+        response = r.json()["energy"]
+
+        if "list" not in response:
+            return {str(site_ids[0]): response["values"]}
+        return {str(item["id"]): item["values"] for item in response["list"]}
+
 if __name__ == "__main__":
     print("\n\nThe solaredge_api.py is directly called, not supposed to do so...\n\n")
\ No newline at end of file
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"""
+    Call plan for the SolarEdge API
+    Determines the fewest API calls covering the missing periods of all sites:
+    - Each call spans the longest period the timeUnit allows
+    - Sites missing the same period are combined into one bulk call
+"""
+
+import logging
+import datetime
+from collections import namedtuple
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# One API call: period start..stop (dates, inclusive) for a tuple of site_ids
+Call = namedtuple("Call", ["start", "stop", "site_ids"])
+
+
+def plan_calls(missing, max_period, max_sites=100):
+    """
+        Plan the API calls for the missing periods
+
+        :param missing: dict site_id -> list of (start, stop) dates (inclusive)
+        :param max_period: relativedelta, longest period of one call (None: no limit)
+        :param max_sites: maximum amount of sites in one bulk call
+        :return list of Call, in date order
+    """
+    one_day = datetime.timedelta(days=1)
+
+    # All missing periods of all sites, ordered by start date
+    remaining = sorted(
+        (start, stop, site_id)
+        for site_id, periods in missing.items()
+        for start, stop in periods
+        if start <= stop
+    )
+
+    calls = []
+    while len(remaining) > 0:
+        # Greedy: the first missing day starts a call which is as long as allowed,
+        # this gives the fewest calls covering all missing days
+        start = remaining[0][0]
+        if max_period is None:
+            stop = max(period[1] for period in remaining)
+        else:
+            stop = start + max_period - one_day
+
+        # Don't ask for more than needed
+        in_call = [period for period in remaining if period[0] <= stop]
+        stop = min(stop, max(period[1] for period in in_call))
+
+        # All sites missing something in this period go into (bulk) calls
+        site_ids = sorted({period[2] for period in in_call})
+        for i in range(0, len(site_ids), max_sites):
+            calls.append(Call(start, stop, tuple(site_ids[i : i + max_sites])))
+
+        # What is left after this call
+        remaining = sorted(
+            (max(period[0], stop + one_day), period[1], period[2])
+            for period in remaining
+            if period[1] > stop
+        )
+
+    logger.debug(f"Planned {len(calls)} calls for {len(missing)} sites")
+
+    return calls
+
+
+def clip(periods, start, stop):
+    """
+        The part of periods within start..stop (dates, inclusive)
+        A bulk call spans the periods of all its sites, this gives the
+        periods one site of the call is missing.
+
+        :param periods: list of (start, stop) dates (inclusive)
+        :return list of (start, stop) dates
+    """
+    return [
+        (max(period[0], start), min(period[1], stop))
+        for period in periods
+        if period[0] <= stop and period[1] >= start
+    ]
+
+
+if __name__ == "__main__":
+    print("\n\nThe solaredge_plan.py is directly called, not supposed to do so...\n\n")
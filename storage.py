@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+
+"""
+    Storage writer for the SQLite database
+    - Connections in WAL mode with sensible pragmas, readers don't block the writer
+    - Batched upserts (INSERT ... ON CONFLICT) in one transaction, rows which
+      are already stored unchanged are not written again
+    - Low-water marks: the earliest epoch written to a table since the
+      readers of that table last caught up (table low_water)
+"""
+
+import logging
+import sqlite3
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+DATABASE = "database.db"
+
+# Rows per executemany batch
+CHUNK_SIZE = 5000
+
+LOW_WATER_TABLE = "low_water"
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -64000,  # 64 MB
+    "busy_timeout": 60000,  # ms
+}
+
+
+def connect(database=DATABASE):
+    """
+        Opens the database, sets the pragmas
+        returns sqlite3 connection
+    """
+    conn = sqlite3.connect(database, timeout=PRAGMAS["busy_timeout"] / 1000)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value};")
+    return conn
+
+
+def table_exists(conn, table):
+    sql = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;"
+    return conn.execute(sql, (table,)).fetchone() is not None
+
+
+def table_columns(conn, table):
+    """
+        returns list of (name, type, part of primary key)
+    """
+    return [
+        (row[1], row[2], row[5] > 0)
+        for row in conn.execute(f"PRAGMA table_info({table});")
+    ]
+
+
+def create_table(conn, table, columns, key):
+    """
+        Creates table (if not existing)
+
+        :param columns: dict column name -> SQL type
+        :param key: list of column names, the primary key
+    """
+    definition = ", ".join(
+        f'"{name}" {sql_type}' + (" NOT NULL" if name in key else "")
+        for name, sql_type in columns.items()
+    )
+    primary_key = ", ".join(f'"{name}"' for name in key)
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ( {definition}, PRIMARY KEY ({primary_key}) );"
+    )
+
+
+def upsert_sql(table, columns, key):
+    """
+        INSERT ... ON CONFLICT statement for table, only updates
+        rows of which a value changed
+    """
+    names = ", ".join(f'"{name}"' for name in columns)
+    values = ", ".join("?" for _ in columns)
+    conflict = ", ".join(f'"{name}"' for name in key)
+
+    others = [name for name in columns if name not in key]
+    if len(others) == 0:
+        return f"INSERT INTO {table} ({names}) VALUES ({values}) ON CONFLICT ({conflict}) DO NOTHING;"
+
+    update = ", ".join(f'"{name}" = excluded."{name}"' for name in others)
+    changed = " OR ".join(f'"{name}" IS NOT excluded."{name}"' for name in others)
+    return (
+        f"INSERT INTO {table} ({names}) VALUES ({values}) "
+        f"ON CONFLICT ({conflict}) DO UPDATE SET {update} WHERE {changed};"
+    )
+
+
+def upsert(conn, table, columns, rows, key, chunk_size=CHUNK_SIZE, commit=True):
+    """
+        Inserts or updates rows (iterable of tuples in the order of columns)
+        in one transaction. commit=False leaves the transaction open, the
+        caller commits (e.g. after writing more in the same transaction).
+
+        returns the amount of rows inserted or changed
+    """
+    sql = upsert_sql(table, columns, key)
+    changes = conn.total_changes
+
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                conn.executemany(sql, chunk)
+                chunk = []
+        if len(chunk) > 0:
+            conn.executemany(sql, chunk)
+        if commit:
+            conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    changes = conn.total_changes - changes
+    logger.debug(f"{table}: {changes} rows inserted or changed")
+    return changes
+
+
+def frame_rows(frame, index=True):
+    """
+        Rows of a DataFrame as tuples of plain Python values,
+        times as text ("YYYY-MM-DD HH:MM:SS") like pandas.to_sql does
+
+        returns list of column names, iterator of tuples
+    """
+    if index:
+        frame = frame.reset_index()
+
+    frame = frame.copy()
+    for name in frame.columns:
+        if frame[name].dtype.kind == "M":
+            frame[name] = frame[name].dt.strftime("%Y-%m-%d %H:%M:%S")
+
+    # NaN is stored as NULL
+    frame = frame.astype(object).where(frame.notna(), None)
+
+    return list(frame.columns), frame.itertuples(index=False, name=None)
+
+
+def sql_types(frame, index=True):
+    """
+        SQL types of the columns of a DataFrame
+        returns dict column name -> SQL type
+    """
+    if index:
+        frame = frame.reset_index()
+
+    types = {}
+    for name in frame.columns:
+        kind = frame[name].dtype.kind
+        if kind in "iub":
+            types[name] = "INTEGER"
+        elif kind == "f":
+            types[name] = "REAL"
+        elif kind == "M":
+            types[name] = "DATETIME"
+        else:
+            types[name] = "TEXT"
+    return types
+
+
+def upsert_frame(conn, table, frame, key, index=True, chunk_size=CHUNK_SIZE):
+    """
+        Upserts a DataFrame, creates the table with primary key `key`
+        when it doesn't exist yet
+
+        returns the amount of rows inserted or changed
+    """
+    create_table(conn, table, sql_types(frame, index), key)
+    columns, rows = frame_rows(frame, index)
+    return upsert(conn, table, columns, rows, key, chunk_size)
+
+
+def rebuild_table(conn, table, columns, key, order_by=None):
+    """
+        Rebuilds a table with only `columns` (dict column name -> SQL type)
+        and primary key `key`, in one transaction. Double rows are removed:
+        the last one (in order_by order) is kept. Space is given back afterwards.
+    """
+    names = ", ".join(f'"{name}"' for name in columns)
+    order = f" ORDER BY {order_by}" if order_by is not None else ""
+
+    logger.info(f"Rebuilding {table}: {', '.join(columns)}, key ({', '.join(key)})")
+    conn.commit()
+    try:
+        conn.execute("BEGIN;")
+        conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old;")
+        create_table(conn, table, columns, key)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} ({names}) SELECT {names} FROM {table}_old{order};"
+        )
+        conn.execute(f"DROP TABLE {table}_old;")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    conn.execute("VACUUM;")
+
+
+def mark_low_water(conn, table, epoch):
+    """
+        Records that rows of table from epoch (seconds) on were written,
+        the lowest epoch since the mark was cleared is kept. In the
+        transaction of the caller, the caller commits.
+    """
+    create_table(conn, LOW_WATER_TABLE, {"source": "TEXT", "epoch": "INTEGER"}, ["source"])
+    conn.execute(
+        f"""INSERT INTO {LOW_WATER_TABLE} (source, epoch) VALUES (?, ?)
+            ON CONFLICT (source) DO UPDATE SET epoch = MIN(epoch, excluded.epoch);""",
+        (table, int(epoch)),
+    )
+
+
+def low_water(conn, tables):
+    """
+        Lowest epoch written to tables since their marks were cleared,
+        None when nothing was written
+    """
+    if not table_exists(conn, LOW_WATER_TABLE):
+        return None
+    sql = f"SELECT MIN(epoch) FROM {LOW_WATER_TABLE} WHERE source IN ({', '.join('?' * len(tables))});"
+    return conn.execute(sql, list(tables)).fetchone()[0]
+
+
+def clear_low_water(conn, tables, epoch=None):
+    """
+        Clears the marks of tables. With epoch only the marks which are not
+        below epoch: rows written before epoch in the meantime stay marked.
+    """
+    if not table_exists(conn, LOW_WATER_TABLE):
+        return
+    sql = f"DELETE FROM {LOW_WATER_TABLE} WHERE source IN ({', '.join('?' * len(tables))})"
+    params = list(tables)
+    if epoch is not None:
+        sql += " AND epoch >= ?"
+        params.append(int(epoch))
+    conn.execute(sql + ";", params)
+    conn.commit()
+
+
+if __name__ == "__main__":
+    print("\n\nThe storage.py is directly called, not supposed to do so...\n\n")
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+"""
+    Sync planner
+    - Determines which days are missing in a source table (holes included,
+      not only after the last date)
+    - Keeps the fetch state per interval in table sync_state, so a rerun
+      after a crash does the least work and intervals without data at the
+      source are not asked for again
+"""
+
+import logging
+import datetime
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# Intervals ending this many days ago are not expected to change anymore
+SETTLE_DAYS = 2
+
+
+def prepare_tables(conn):
+    """
+        Creates table for the fetch state (if not existing) on conn
+    """
+    sql = """CREATE TABLE IF NOT EXISTS sync_state (
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                start DATE NOT NULL,
+                stop DATE NOT NULL,
+                status TEXT NOT NULL,
+                rows INT,
+                updated DATETIME NOT NULL,
+                PRIMARY KEY (source, key, start, stop) );
+            """
+    conn.execute(sql)
+    conn.commit()
+
+
+def present_days(conn, sql, params=()):
+    """
+        Runs sql, which returns one day ("YYYY-MM-DD") per row.
+        The sql should be answered from an index on the timestamps,
+        e.g. SELECT DISTINCT substr(tijdstip, 1, 10) ...
+
+        :return set of dates
+    """
+    return {
+        datetime.date.fromisoformat(row[0])
+        for row in conn.execute(sql, params)
+        if row[0] is not None
+    }
+
+
+def missing_intervals(present, start, stop):
+    """
+        Days from start..stop (inclusive) which are not in present
+
+        :param present: set of dates
+        :return list of (start, stop) dates, consecutive days combined
+    """
+    intervals = []
+    one_day = datetime.timedelta(days=1)
+
+    day = start
+    while day <= stop:
+        if day not in present:
+            if len(intervals) > 0 and intervals[-1][1] == day - one_day:
+                intervals[-1] = (intervals[-1][0], day)
+            else:
+                intervals.append((day, day))
+        day += one_day
+
+    return intervals
+
+
+def subtract(intervals, skip):
+    """
+        Removes the days in skip from intervals (both lists of (start, stop))
+    """
+    one_day = datetime.timedelta(days=1)
+
+    for skip_start, skip_stop in skip:
+        result = []
+        for start, stop in intervals:
+            if stop < skip_start or start > skip_stop:
+                result.append((start, stop))
+                continue
+            if start < skip_start:
+                result.append((start, skip_start - one_day))
+            if stop > skip_stop:
+                result.append((skip_stop + one_day, stop))
+        intervals = result
+
+    return sorted(intervals)
+
+
+def split(intervals, days):
+    """
+        Splits intervals into windows of at most `days` days
+    """
+    windows = []
+    for start, stop in intervals:
+        while start <= stop:
+            window_stop = min(stop, start + datetime.timedelta(days=days - 1))
+            windows.append((start, window_stop))
+            start = window_stop + datetime.timedelta(days=1)
+    return windows
+
+
+def settled_intervals(conn, source, key):
+    """
+        Intervals which were fetched without getting any data and are old
+        enough not to change anymore, these don't have to be fetched again
+
+        :return list of (start, stop) dates
+    """
+    cutoff = datetime.date.today() - datetime.timedelta(days=SETTLE_DAYS)
+    sql = """SELECT start, stop FROM sync_state
+                WHERE source = ? AND key = ? AND status = 'done' AND rows = 0 AND stop < ?
+                ORDER BY start;"""
+    return [
+        (datetime.date.fromisoformat(start), datetime.date.fromisoformat(stop))
+        for start, stop in conn.execute(sql, (source, str(key), cutoff.isoformat()))
+    ]
+
+
+def plan(conn, source, key, present, start, stop):
+    """
+        Missing intervals of source/key in start..stop, leaving out the
+        settled intervals
+
+        :return list of (start, stop) dates
+    """
+    intervals = subtract(
+        missing_intervals(present, start, stop), settled_intervals(conn, source, key)
+    )
+    logger.debug(f"{source} {key}: {len(intervals)} missing interval(s)")
+    return intervals
+
+
+def mark_interval(conn, source, key, start, stop, status, rows=None):
+    """
+        Saves the fetch state of an interval ('pending' or 'done' with
+        the amount of rows received), the caller commits
+    """
+    conn.execute(
+        "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?, ?, DATETIME('now'));",
+        (source, str(key), start.isoformat(), stop.isoformat(), status, rows),
+    )
+
+
+if __name__ == "__main__":
+    print("\n\nThe sync_planner.py is directly called, not supposed to do so...\n\n")
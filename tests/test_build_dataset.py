@@ -0,0 +1,136 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+import build_dataset
+import inlezen
+import locaties
+import ophalen_solaredge
+import ophalen_weer
+import rollups
+import storage
+
+
+SITE_ID = "1111"
+START = datetime.date(2021, 6, 1)
+
+
+def add_days(database, first_day, days):
+    """
+        SolarEdge (per quarter of an hour) and KNMI history (the nearest
+        stations) of days from first_day. Energy of a quarter and the
+        temperature (°C) are both the UTC hour of the measurement.
+    """
+    conn = storage.connect(database)
+    ophalen_solaredge.prepare_tables(conn)
+    rollups.prepare_tables(conn)
+    ophalen_weer.prepare_tables(conn)
+
+    tijden = pd.date_range(
+        pd.Timestamp(first_day, tz="UTC"), periods=days * 96, freq="15min"
+    )
+    lokaal = tijden.tz_convert("Europe/Amsterdam").tz_localize(None)
+    data = [
+        {"date": str(tijdstip), "value": float(utc.hour)} for tijdstip, utc in zip(lokaal, tijden)
+    ]
+    storage.upsert(
+        conn,
+        "solaredge_history",
+        ["site_id", "tijdstip", "epoch", "energy"],
+        ophalen_solaredge.production_to_records(SITE_ID, data),
+        ["site_id", "epoch"],
+    )
+    rollups.update(
+        conn, SITE_ID, first_day - datetime.timedelta(days=1), first_day + datetime.timedelta(days=days)
+    )
+
+    # KNMI: hour 1-24 of a date, hour HH is the measurement of HH-1:00 - HH:00 UTC
+    stations, _ = ophalen_weer.nearest_stations(*locaties.get_location())
+    batch = [
+        {
+            "station_code": station,
+            "date": f"{first_day + datetime.timedelta(days=day)}T00:00:00.000Z",
+            "hour": hour,
+            "T": (hour - 1) * 10,
+            "DR": 0,
+            "N": 4,
+        }
+        for station in stations
+        for day in range(days)
+        for hour in range(1, 25)
+    ]
+    ophalen_weer.store_batch(conn, batch, set())
+    conn.close()
+
+
+class TestCombineData(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.directory.name, "database.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def dataset(self):
+        conn = storage.connect(self.database)
+        data = inlezen.dataset(conn)
+        epochs = np.array([row[0] for row in conn.execute("SELECT epoch FROM dataset ORDER BY epoch;")])
+        conn.close()
+        return data, epochs
+
+    def check_epochs(self, epochs, days):
+        # Every hour of the fixture period once, one hour apart
+        self.assertEqual(len(epochs), days * 24)
+        self.assertEqual(len(set(epochs)), len(epochs))
+        self.assertTrue((np.diff(epochs) == 3600).all())
+        self.assertEqual(epochs[0], int(pd.Timestamp(START, tz="UTC").timestamp()))
+
+    def check_hours(self, data):
+        # SolarEdge and KNMI of the same hour on one row: both keyed on its start
+        hours = data.index.hour.to_numpy()
+        np.testing.assert_array_equal(data["energy"].to_numpy(), 4 * hours)
+        np.testing.assert_allclose(data["temperatuur"].to_numpy(), hours)
+
+    def test_full(self):
+        add_days(self.database, START, 10)
+        build_dataset.combine_data(full=True, database=self.database)
+
+        data, epochs = self.dataset()
+        self.check_epochs(epochs, 10)
+        self.check_hours(data)
+
+    def test_incremental(self):
+        add_days(self.database, START, 8)
+        build_dataset.combine_data(database=self.database)
+        add_days(self.database, START + datetime.timedelta(days=8), 2)
+        build_dataset.combine_data(database=self.database)
+
+        data, epochs = self.dataset()
+        self.check_epochs(epochs, 10)
+        self.check_hours(data)
+        # Features of the new hours are computed with the history before them
+        self.assertFalse(data["energy_lag_24"].iloc[-48:].isna().any())
+
+    def test_backfilled_gap(self):
+        # Days 3 and 4 are fetched after the dataset was built
+        add_days(self.database, START, 3)
+        add_days(self.database, START + datetime.timedelta(days=5), 5)
+        build_dataset.combine_data(database=self.database)
+        add_days(self.database, START + datetime.timedelta(days=3), 2)
+        build_dataset.combine_data(database=self.database)
+
+        data, epochs = self.dataset()
+        self.check_epochs(epochs, 10)
+        self.check_hours(data)
+
+        conn = storage.connect(self.database)
+        self.assertIsNone(storage.low_water(conn, build_dataset.BRONNEN))
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
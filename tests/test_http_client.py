@@ -0,0 +1,172 @@
+import http.server
+import json
+import tempfile
+import threading
+import unittest
+
+import requests
+
+import http_client
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+        Answers from server.responses: path -> list of (status, headers, body),
+        the last one is repeated. Requests are kept in server.requests.
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        responses = self.server.responses[self.path.split("?")[0]]
+        status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+
+        if callable(body):
+            status, headers, body = body(self)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.responses = {}
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.client = http_client.HttpClient(
+            timeout=(2, 2), retries=3, backoff=0.0, backoff_max=0.05, cache_dir=self.cache_dir.name
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.session.close()
+        self.cache_dir.cleanup()
+
+
+class TestRetry(StubServerTest):
+    def test_retries_until_ok(self):
+        self.server.responses["/energy"] = [
+            (503, {}, b""),
+            (429, {"Retry-After": "0"}, b""),
+            (200, {}, b'{"ok": true}'),
+        ]
+        attempts = []
+        r = self.client.get(self.url + "/energy", before_request=lambda: attempts.append(1))
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json(), {"ok": True})
+        self.assertEqual(len(self.server.requests), 3)
+        # The hook (rate limiter) is called for every attempt
+        self.assertEqual(len(attempts), 3)
+
+        stats = self.client.stats[http_client.HttpClient.endpoint(self.url + "/energy")]
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["calls"], 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.responses["/energy"] = [(500, {}, b"")]
+        r = self.client.get(self.url + "/energy")
+
+        self.assertEqual(r.status_code, 500)
+        self.assertEqual(len(self.server.requests), self.client.retries + 1)
+
+    def test_no_retry_on_client_error(self):
+        self.server.responses["/energy"] = [(403, {}, b"")]
+        self.assertEqual(self.client.get(self.url + "/energy").status_code, 403)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_wait(self):
+        response = requests.Response()
+        response.headers["Retry-After"] = "120"
+        # Retry-After, but never more than backoff_max
+        self.assertEqual(self.client._wait(0, response), self.client.backoff_max)
+
+        client = http_client.HttpClient(backoff=1.0, backoff_max=30.0)
+        for attempt in range(8):
+            self.assertLessEqual(client._wait(attempt), min(30.0, 2 ** attempt))
+
+
+class TestCache(StubServerTest):
+    def revalidate(self, handler):
+        if handler.headers.get("If-None-Match") == '"v1"':
+            return 304, {"ETag": '"v1"'}, b""
+        return 200, {"ETag": '"v1"'}, b'{"serie": [1, 2, 3]}'
+
+    def test_etag_revalidation(self):
+        self.server.responses["/forecast"] = [(200, {}, self.revalidate)]
+
+        first = self.client.get_cached(self.url + "/forecast")
+        self.assertTrue(first.changed)
+        self.assertEqual(first.json(), {"serie": [1, 2, 3]})
+        first.mark_processed()
+
+        second = self.client.get_cached(self.url + "/forecast")
+        self.assertEqual(self.server.requests[-1][1].get("If-None-Match"), '"v1"')
+        self.assertFalse(second.changed)
+        self.assertEqual(second.json(), {"serie": [1, 2, 3]})
+
+        stats = self.client.stats[http_client.HttpClient.endpoint(self.url + "/forecast")]
+        self.assertEqual(stats["cached"], 1)
+
+    def test_changed_body(self):
+        self.server.responses["/forecast"] = [
+            (200, {"ETag": '"v1"'}, b'{"serie": [1]}'),
+            (200, {"ETag": '"v2"'}, b'{"serie": [2]}'),
+        ]
+        self.client.get_cached(self.url + "/forecast").mark_processed()
+
+        second = self.client.get_cached(self.url + "/forecast")
+        self.assertTrue(second.changed)
+        self.assertEqual(second.json(), {"serie": [2]})
+
+    def test_same_body_without_validators(self):
+        self.server.responses["/forecast"] = [(200, {}, b'{"serie": [1]}')]
+        self.client.get_cached(self.url + "/forecast").mark_processed()
+        self.assertFalse(self.client.get_cached(self.url + "/forecast").changed)
+
+
+class TestStreaming(StubServerTest):
+    rows = [{"station_code": 260, "date": "2021-03-28T00:00:00.000Z", "hour": hour, "T": hour * 10} for hour in range(1, 25)]
+
+    def stream(self, body, chunk_size=7):
+        self.server.responses["/knmi"] = [(200, {"Content-Type": "application/json"}, body)]
+        r = self.client.get(self.url + "/knmi", stream=True)
+        with r:
+            return list(http_client.iter_json_array(r, chunk_size=chunk_size))
+
+    def test_objects_over_chunks(self):
+        body = json.dumps(self.rows, indent=1).encode()
+        self.assertEqual(self.stream(body), self.rows)
+        self.assertEqual(self.stream(body, chunk_size=len(body)), self.rows)
+
+    def test_utf8_split_over_chunks(self):
+        rows = [{"naam": "De Bilt °C"}, {"naam": "Zuid-Holland é"}]
+        self.assertEqual(self.stream(json.dumps(rows, ensure_ascii=False).encode(), chunk_size=1), rows)
+
+    def test_empty_array(self):
+        self.assertEqual(self.stream(b"[ ]"), [])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            self.stream(b'{"error": "no data"}')
+
+    def test_truncated(self):
+        body = json.dumps(self.rows).encode()
+        with self.assertRaisesRegex(ValueError, "Truncated JSON array"):
+            self.stream(body[: len(body) // 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
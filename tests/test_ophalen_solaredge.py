@@ -0,0 +1,74 @@
+import datetime
+import json
+import os
+import unittest
+
+import ophalen_solaredge
+import solaredge_plan
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def d(text):
+    return datetime.date.fromisoformat(text)
+
+
+def bulk_response():
+    """
+        Bulk energy response (timeUnit HOUR) of sites 1111 and 2222,
+        2021-03-27 .. 2021-03-29, start of daylight saving time included
+    """
+    with open(os.path.join(FIXTURES, "solaredge_bulk_energy.json")) as file:
+        response = json.load(file)["energy"]
+    return {str(item["id"]): item["values"] for item in response["list"]}
+
+
+class TestProductionToRecords(unittest.TestCase):
+    def test_no_value_is_not_stored(self):
+        values = bulk_response()["1111"]
+        records = ophalen_solaredge.production_to_records(1111, values)
+
+        self.assertEqual(len(records), sum(item["value"] is not None for item in values))
+        # A measured zero is kept
+        self.assertIn(0, [record[3] for record in records])
+
+    def test_skipped_hour(self):
+        values = bulk_response()["1111"]
+        values = [item for item in values if item["date"].startswith("2021-03-28 02")]
+        values[0]["value"] = 1.0
+        self.assertEqual(ophalen_solaredge.production_to_records(1111, values), [])
+
+    def test_clipped_to_missing_periods(self):
+        # One call for both sites, site 2222 only misses the last day
+        missing = {
+            "1111": [(d("2021-03-27"), d("2021-03-29"))],
+            "2222": [(d("2021-03-29"), d("2021-03-29"))],
+        }
+        calls = solaredge_plan.plan_calls(missing, None)
+        self.assertEqual(calls, [solaredge_plan.Call(d("2021-03-27"), d("2021-03-29"), ("1111", "2222"))])
+
+        result = bulk_response()
+        per_site = {
+            site_id: ophalen_solaredge.production_to_records(
+                site_id,
+                result[site_id],
+                solaredge_plan.clip(missing[site_id], calls[0].start, calls[0].stop),
+            )
+            for site_id in calls[0].site_ids
+        }
+
+        self.assertEqual(
+            {record[1].date() for record in per_site["1111"]},
+            {d("2021-03-27"), d("2021-03-28"), d("2021-03-29")},
+        )
+        self.assertEqual({record[1].date() for record in per_site["2222"]}, {d("2021-03-29")})
+
+        # Epochs are unique per site (no double hour at the clock change)
+        for records in per_site.values():
+            epochs = [record[2] for record in records]
+            self.assertEqual(len(epochs), len(set(epochs)))
+
+
+if __name__ == "__main__":
+    unittest.main()
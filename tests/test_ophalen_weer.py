@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+
+import ophalen_weer
+import storage
+
+
+class TestVersmallen(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.conn = storage.connect(os.path.join(self.directory.name, "database.db"))
+
+        # A table of an older install, with a variable which isn't used anymore
+        ophalen_weer.prepare_tables(self.conn, ["T", "RH", "N"])
+        ophalen_weer.store_batch(
+            self.conn,
+            [
+                {"station_code": 377, "date": "2021-06-01T00:00:00.000Z", "hour": hour, "T": 150, "RH": 3, "N": 4}
+                for hour in range(1, 25)
+            ],
+            set(),
+            ["T", "RH", "N"],
+        )
+
+    def tearDown(self):
+        self.conn.close()
+        self.directory.cleanup()
+
+    def test_prepare_tables_keeps_columns(self):
+        ophalen_weer.prepare_tables(self.conn, ["T", "N"])
+        columns = [name for name, _, _ in storage.table_columns(self.conn, "knmi_history")]
+        self.assertIn("RH", columns)
+
+    def test_versmallen(self):
+        self.assertEqual(ophalen_weer.versmallen(self.conn, ["T", "N"]), ["RH"])
+
+        columns = storage.table_columns(self.conn, "knmi_history")
+        self.assertEqual([name for name, _, _ in columns], ["station_code", "date", "hour", "epoch", "T", "N"])
+        self.assertEqual([name for name, _, key in columns if key], ophalen_weer.KEY)
+        self.assertEqual(
+            self.conn.execute('SELECT COUNT(*), SUM("T"), SUM("N") FROM knmi_history;').fetchone(),
+            (24, 24 * 150, 24 * 4),
+        )
+        indexes = [row[1] for row in self.conn.execute("PRAGMA index_list(knmi_history);")]
+        self.assertIn("knmi_history_epoch", indexes)
+
+        # Nothing left to drop
+        self.assertEqual(ophalen_weer.versmallen(self.conn, ["T", "N"]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
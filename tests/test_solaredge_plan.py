@@ -0,0 +1,82 @@
+import datetime
+import unittest
+
+from dateutil.relativedelta import relativedelta
+
+import solaredge_plan
+from solaredge_plan import Call
+
+
+def d(text):
+    return datetime.date.fromisoformat(text)
+
+
+class TestPlanCalls(unittest.TestCase):
+    def test_nothing_missing(self):
+        self.assertEqual(solaredge_plan.plan_calls({}, relativedelta(months=1)), [])
+        self.assertEqual(solaredge_plan.plan_calls({1: []}, relativedelta(months=1)), [])
+
+    def test_one_site_split_by_max_period(self):
+        calls = solaredge_plan.plan_calls(
+            {1: [(d("2021-01-01"), d("2021-02-15"))]}, relativedelta(months=1)
+        )
+        self.assertEqual(
+            calls,
+            [
+                Call(d("2021-01-01"), d("2021-01-31"), (1,)),
+                Call(d("2021-02-01"), d("2021-02-15"), (1,)),
+            ],
+        )
+
+    def test_sites_share_a_call(self):
+        calls = solaredge_plan.plan_calls(
+            {
+                2: [(d("2021-03-10"), d("2021-03-12"))],
+                1: [(d("2021-03-01"), d("2021-03-05"))],
+            },
+            relativedelta(months=1),
+        )
+        self.assertEqual(calls, [Call(d("2021-03-01"), d("2021-03-12"), (1, 2))])
+
+    def test_no_limit(self):
+        calls = solaredge_plan.plan_calls(
+            {1: [(d("2019-01-01"), d("2019-01-02")), (d("2021-06-01"), d("2021-06-30"))]}, None
+        )
+        self.assertEqual(calls, [Call(d("2019-01-01"), d("2021-06-30"), (1,))])
+
+    def test_max_sites(self):
+        missing = {site_id: [(d("2021-01-01"), d("2021-01-01"))] for site_id in range(5)}
+        calls = solaredge_plan.plan_calls(missing, relativedelta(months=1), max_sites=2)
+        self.assertEqual([call.site_ids for call in calls], [(0, 1), (2, 3), (4,)])
+
+    def test_every_missing_day_covered_once(self):
+        missing = {
+            1: [(d("2021-01-01"), d("2021-01-10")), (d("2021-03-01"), d("2021-04-20"))],
+            2: [(d("2021-01-05"), d("2021-02-10"))],
+            3: [(d("2021-04-01"), d("2021-04-01"))],
+        }
+        calls = solaredge_plan.plan_calls(missing, relativedelta(months=1))
+
+        for call in calls:
+            self.assertLess(call.stop, call.start + relativedelta(months=1))
+        for site_id, periods in missing.items():
+            for start, stop in periods:
+                day = start
+                while day <= stop:
+                    covering = [c for c in calls if c.start <= day <= c.stop and site_id in c.site_ids]
+                    self.assertEqual(len(covering), 1, (site_id, day))
+                    day += datetime.timedelta(days=1)
+
+
+class TestClip(unittest.TestCase):
+    def test_clip(self):
+        periods = [(d("2021-01-01"), d("2021-01-10")), (d("2021-01-20"), d("2021-02-05"))]
+        self.assertEqual(
+            solaredge_plan.clip(periods, d("2021-01-05"), d("2021-01-31")),
+            [(d("2021-01-05"), d("2021-01-10")), (d("2021-01-20"), d("2021-01-31"))],
+        )
+        self.assertEqual(solaredge_plan.clip(periods, d("2021-01-11"), d("2021-01-19")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+import features
+import ophalen_weersvoorspelling
+import storage
+import tijdas
+import trainen
+import voorspelserver
+
+
+def fixture_database(database, now):
+    """
+        Dataset of 60 days up to now (features as build_dataset computes
+        them) and a forecast of 5 days issued an hour ago
+    """
+    conn = storage.connect(database)
+
+    index = pd.date_range(now - pd.Timedelta(days=60), now - pd.Timedelta(hours=1), freq="h", name="Time")
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(
+        {
+            "temperatuur": rng.random(len(index)) * 20,
+            "duur_neerslag": 0.0,
+            "bewolking": rng.integers(0, 9, len(index)).astype(float),
+            "solar_altitude": 50 * np.sin((index.hour - 6) / 12 * np.pi),
+            "solar_azimuth": index.hour * 15.0,
+        },
+        index=index,
+    )
+    data["energy"] = np.clip(data["solar_altitude"], 0, None) * 20 * (1 - data["bewolking"] / 10)
+    data = data.join(features.bereken(data))
+    data.insert(0, "epoch", tijdas.index_naar_epoch(data.index))
+    storage.upsert_frame(conn, "dataset", data, ["epoch"])
+
+    # KNMI gives a value every few hours
+    tijdstippen = pd.date_range(now, now + pd.Timedelta(days=5), freq="6h", name="Tijdstip").tz_localize(None)
+    voorspelling = pd.DataFrame(
+        {
+            "temperatuur": 10.0,
+            "neerslag": 0.0,
+            "bewolking": np.resize([0.0, 8.0], len(tijdstippen)),
+        },
+        index=tijdstippen,
+    )
+    issue_time = (now - pd.Timedelta(hours=1)).tz_localize(None).to_pydatetime()
+    ophalen_weersvoorspelling.opslaan(conn, voorspelling, issue_time)
+    conn.close()
+
+
+class TestVoorspeller(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = os.path.join(cls.directory.name, "database.db")
+        cls.modellen = os.path.join(cls.directory.name, "modellen")
+        cls.now = pd.Timestamp.now(tz="UTC").floor("h")
+
+        fixture_database(cls.database, cls.now)
+        conn = storage.connect(cls.database)
+        trainen.trainen(conn, directory=cls.modellen)
+        conn.close()
+
+        cls.voorspeller = voorspelserver.Voorspeller(cls.database, cls.modellen)
+        cls.voorspeller.laden()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_loaded(self):
+        energie = self.voorspeller.energie
+        self.assertEqual(energie.index[0], self.now)
+        self.assertEqual(len(energie), 5 * 24 + 1)
+        self.assertFalse(energie.isna().any())
+        self.assertEqual(self.voorspeller.versie, self.voorspeller.versie_op_schijf())
+
+    def test_per_uur(self):
+        uren = self.voorspeller.voorspelling(dagen=1, per="uur", nu=self.now + pd.Timedelta(minutes=30))
+        self.assertEqual(len(uren), 24)
+        self.assertEqual(uren[0]["tijd"], self.now.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+    def test_per_dag(self):
+        nu = self.now + pd.Timedelta(days=1)
+        dagen = self.voorspeller.voorspelling(dagen=2, per="dag", nu=nu)
+
+        lokaal = nu.tz_convert(tijdas.LOCAL_TZ)
+        eerste = lokaal.normalize()
+        self.assertEqual(
+            [dag["tijd"] for dag in dagen],
+            [eerste.strftime("%Y-%m-%d"), (eerste + pd.DateOffset(days=1)).strftime("%Y-%m-%d")],
+        )
+
+        # Whole local days, from midnight to midnight
+        energie = self.voorspeller.energie
+        energie = energie[(energie.index >= eerste) & (energie.index < eerste + pd.DateOffset(days=1))]
+        self.assertAlmostEqual(dagen[0]["kwh"], round(float(energie.sum()), 3), places=3)
+
+    def test_server(self):
+        server = voorspelserver.maak_server(self.voorspeller, port=0)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            with urllib.request.urlopen(url + "/voorspelling?dagen=2&per=dag") as r:
+                body = json.load(r)
+            self.assertEqual(body["per"], "dag")
+            self.assertEqual(body["uren"], 5 * 24 + 1)
+            self.assertEqual(len(body["energie"]), 2)
+
+            with urllib.request.urlopen(url + "/status") as r:
+                self.assertEqual(json.load(r)["geladen"]["forecast"], self.voorspeller.versie[1])
+
+            for path, status in (("/voorspelling?per=week", 400), ("/voorspelling?dagen=x", 400), ("/x", 404)):
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(url + path)
+                self.assertEqual(e.exception.code, status)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestVoorspellingPerDag(unittest.TestCase):
+    def setUp(self):
+        # 1 kWh every hour, around the start of daylight saving time (28 March 2021)
+        index = pd.date_range("2021-03-26 23:00", "2021-03-31 22:00", freq="h", tz="UTC")
+        self.voorspeller = voorspelserver.Voorspeller()
+        self.voorspeller.energie = pd.Series(1.0, index=index, name="kwh")
+
+    def test_whole_local_days(self):
+        dagen = self.voorspeller.voorspelling(dagen=2, per="dag", nu="2021-03-27T15:20:00Z")
+        self.assertEqual(dagen, [{"tijd": "2021-03-27", "kwh": 24.0}, {"tijd": "2021-03-28", "kwh": 23.0}])
+
+    def test_after_local_midnight(self):
+        # 23:30 UTC is already the next local day
+        dagen = self.voorspeller.voorspelling(dagen=1, per="dag", nu="2021-03-28T23:30:00Z")
+        self.assertEqual(dagen, [{"tijd": "2021-03-29", "kwh": 24.0}])
+
+    def test_nothing_loaded(self):
+        self.assertIsNone(voorspelserver.Voorspeller().voorspelling())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+"""
+    Time axis of the database
+    All sources are keyed on integer epoch seconds (UTC), next to the
+    original text. Local SolarEdge times are converted once, when written:
+    the repeated hour at the end of daylight saving time is kept apart,
+    times in the skipped hour don't exist and are left out.
+    Readers select on and decode the epoch without parsing text.
+
+    Hourly values are keyed on the start of the hour they cover:
+    - solaredge_hourly: the sum of the quarters from HH:00 up to HH+1:00
+    - knmi_history: KNMI hour HH (1-24) is measured from HH-1:00 up to HH:00
+      UTC, its epoch is the date plus (HH - 1) hours
+    so one epoch is the same hour in every source. Forecasts are keyed on
+    their valid time.
+"""
+
+import datetime
+import logging
+import zoneinfo
+
+import numpy as np
+import pandas as pd
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+# SolarEdge gives the local time of the site
+LOCAL_TZ = zoneinfo.ZoneInfo("Europe/Amsterdam")
+
+
+def lokaal_naar_epoch(tijdstip, tz=LOCAL_TZ, fold=0):
+    """
+        Local time (datetime without timezone) to epoch seconds
+
+        :param fold: 1 for the second pass of the repeated hour when
+                     daylight saving time ends
+        :return epoch seconds, None for a time that doesn't exist
+                (the skipped hour when daylight saving time starts)
+    """
+    utc = tijdstip.replace(tzinfo=tz, fold=fold).astimezone(datetime.timezone.utc)
+    if utc.astimezone(tz).replace(tzinfo=None) != tijdstip:
+        return None
+    return int(utc.timestamp())
+
+
+def lokale_reeks_naar_epoch(tijdstippen, tz=LOCAL_TZ):
+    """
+        Chronological local times (as SolarEdge sends them) to epoch seconds.
+        A time which is not after the latest time so far is the repeated
+        hour at the end of daylight saving time, it gets fold=1.
+
+        :return list of epoch seconds, None for times that don't exist
+    """
+    epochs = []
+    latest = None
+    for tijdstip in tijdstippen:
+        fold = 1 if latest is not None and tijdstip <= latest else 0
+        epochs.append(lokaal_naar_epoch(tijdstip, tz, fold))
+        latest = tijdstip if latest is None else max(latest, tijdstip)
+    return epochs
+
+
+def datum_uur_naar_epoch(dates, hours):
+    """
+        KNMI date ("YYYY-MM-DD...", UTC) and hour (1-24) to epoch seconds,
+        the hour is the end of the measured hour, the epoch its start
+
+        :param dates, hours: sequences of equal length
+        :return numpy array of int64
+    """
+    days = pd.to_datetime(pd.Series(dates).str[:10], format="%Y-%m-%d").to_numpy("datetime64[s]")
+    return days.astype(np.int64) + (np.asarray(hours, dtype=np.int64) - 1) * 3600
+
+
+def naar_epoch(moment):
+    """
+        Time (text, datetime or Timestamp) to epoch seconds,
+        times without timezone are UTC. Integers are already epoch seconds.
+    """
+    if isinstance(moment, (int, np.integer)):
+        return int(moment)
+
+    moment = pd.Timestamp(moment)
+    if moment.tz is None:
+        moment = moment.tz_localize("UTC")
+    return int(moment.timestamp())
+
+
+def naar_index(epochs, name="Time"):
+    """
+        Epoch seconds to a DatetimeIndex in UTC, vectorized
+    """
+    return pd.DatetimeIndex(pd.to_datetime(np.asarray(epochs, dtype=np.int64), unit="s", utc=True), name=name)
+
+
+def index_naar_epoch(index):
+    """
+        DatetimeIndex (with timezone) to epoch seconds, vectorized
+
+        :return numpy array of int64
+    """
+    return index.tz_convert("UTC").tz_localize(None).to_numpy("datetime64[s]").astype(np.int64)
+
+
+def vensters(start, stop, days):
+    """
+        Splits epoch start..stop (stop exclusive) into windows of days
+
+        :return list of (start, stop) epochs
+    """
+    step = int(datetime.timedelta(days=days).total_seconds())
+    return [(begin, min(begin + step, stop)) for begin in range(start, stop, step)]
+
+
+if __name__ == "__main__":
+    print("\n\nThe tijdas.py is directly called, not supposed to do so...\n\n")
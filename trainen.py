@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+
+"""
+    Trains the XGBoost model for the energy of the solar panels and keeps
+    it as an artifact, so it is not trained again on every run
+
+    Usage: python trainen.py [--full]
+
+    The artifact (directory modellen/) is the model (XGBoost JSON) and a
+    metadata file with the fingerprint of the model settings (columns,
+    parameters, feature specs) and of the dataset it was trained on:
+    - dataset and settings unchanged: the artifact is used as it is
+    - only hours added (or the last OVERLAP rewritten by build_dataset):
+      the model is trained further (warm start) on those hours only, when
+      there are at least MIN_WARM_ROWS of them (else it waits for more)
+    - older hours changed, other settings, or MAX_WARM_STARTS warm starts
+      since the last full training: trained from scratch
+    --full always trains from scratch.
+"""
+
+import argparse
+import coloredlogs, logging
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+import features
+import inlezen
+import storage
+import tijdas
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
+
+DIRECTORY = "modellen"
+MODEL_FILE = "xgboost.json"
+META_FILE = "xgboost.meta.json"
+
+# Hours ahead the model is used for (voorspelserver, notebook). Features
+# of the energy are only used when they are known that far ahead: a lag of
+# 24 hours is not known for the second day of the forecast.
+HORIZON = pd.Timedelta(days=3)
+
+# Columns of the dataset the model uses: the features (features.FEATURES)
+# known over the horizon, the weather and the position of the sun
+KOLOMMEN = [
+    *[spec.naam for spec in features.beschikbaar(HORIZON)],
+    "temperatuur",
+    "bewolking",
+    "solar_altitude",
+    "solar_azimuth",
+]
+LABEL = "energy"
+
+# Parameters for training model, see opbrengst_voorspellen.ipynb
+PARAMS = {
+    "objective": "reg:squarederror",
+    "eta": 0.05,
+    "gamma": 1,
+    "max_depth": 10,
+    "lambda": 5,
+    "alpha": 0,
+    "min_child_weight": 1,
+}
+NUM_BOOST_ROUND = 1000
+EARLY_STOPPING_ROUNDS = 10
+
+# Warm start: at most this many rounds on the new hours, then train from
+# scratch again after MAX_WARM_STARTS warm starts. With less than
+# MIN_WARM_ROWS new hours the model is kept as it is.
+WARM_BOOST_ROUND = 20
+MAX_WARM_STARTS = 30
+MIN_WARM_ROWS = 48
+
+# Hours before the last trained hour that build_dataset may rewrite
+# (build_dataset.OVERLAP), these are trained again with the new hours
+OVERLAP = pd.Timedelta(days=1)
+
+# Part of the rows kept apart to score the model (test) and to stop
+# training when it doesn't improve anymore (validation)
+TEST_SIZE = 0.25
+VALID_SIZE = 0.15
+
+
+def instellingen_fingerprint(kolommen=KOLOMMEN, params=PARAMS):
+    """
+        Fingerprint of everything but the data that makes the model:
+        columns, parameters, feature specs and the XGBoost version
+    """
+    settings = {
+        "kolommen": list(kolommen),
+        "label": LABEL,
+        "params": params,
+        "features": [list(spec) for spec in features.FEATURES],
+        "xgboost": xgb.__version__,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def data_fingerprint(data):
+    """
+        Fingerprint of the rows of a DataFrame (index and values)
+    """
+    hashes = pd.util.hash_pandas_object(data, index=True).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+
+def inlezen_data(conn, kolommen=KOLOMMEN):
+    """
+        Columns and label from the dataset, rows without label left out
+        (XGBoost handles missing values in the columns)
+    """
+    data = inlezen.dataset(conn, columns=[*kolommen, LABEL])
+    return data.dropna(subset=[LABEL])
+
+
+def laden(directory=DIRECTORY):
+    """
+        Reads the artifact
+
+        :return (booster, metadata), (None, None) if there is none
+    """
+    model_path = os.path.join(directory, MODEL_FILE)
+    meta_path = os.path.join(directory, META_FILE)
+    if not (os.path.exists(model_path) and os.path.exists(meta_path)):
+        return None, None
+
+    with open(meta_path) as file:
+        meta = json.load(file)
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    return booster, meta
+
+
+def opslaan(booster, meta, directory=DIRECTORY):
+    """
+        Writes the artifact, each file is replaced atomically. The metadata
+        is written last: it only refers to a model that is complete.
+    """
+    os.makedirs(directory, exist_ok=True)
+    model_path = os.path.join(directory, MODEL_FILE)
+    meta_path = os.path.join(directory, META_FILE)
+
+    # XGBoost picks the format from the extension
+    booster.save_model(model_path + ".tmp.json")
+    os.replace(model_path + ".tmp.json", model_path)
+
+    with open(meta_path + ".tmp", "w") as file:
+        json.dump(meta, file, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _split(data):
+    """
+        Rows for training, validation and test. An hour is in the same
+        part on every run (hash of its epoch), so a warm start never
+        trains on the hours the model was scored on.
+    """
+    epochs = tijdas.index_naar_epoch(data.index)
+    plek = (pd.util.hash_array(np.asarray(epochs, dtype="int64")) % 1000) / 1000
+    test = plek < TEST_SIZE
+    valid = ~test & (plek < TEST_SIZE + VALID_SIZE)
+    return data[~test & ~valid], data[valid], data[test]
+
+
+def _scores(booster, data, kolommen):
+    """
+        r² and RMSE of the model on data
+    """
+    if len(data) == 0:
+        return {"r2": None, "rmse": None}
+    y = data[LABEL].to_numpy()
+    pred = booster.predict(xgb.DMatrix(data=data[kolommen]))
+    residu = np.sum((y - pred) ** 2)
+    totaal = np.sum((y - y.mean()) ** 2)
+    return {
+        "r2": float(1 - residu / totaal) if totaal > 0 else None,
+        "rmse": float(np.sqrt(residu / len(y))),
+    }
+
+
+def _train(train, valid, kolommen, params, num_boost_round, booster=None):
+    """
+        Boosting rounds on train, stops when the rmse on valid doesn't
+        improve in EARLY_STOPPING_ROUNDS (the best round is kept)
+    """
+    dtrain = xgb.DMatrix(data=train[kolommen], label=train[LABEL])
+    dvalid = xgb.DMatrix(data=valid[kolommen], label=valid[LABEL])
+    booster = xgb.train(
+        params={**params, "eval_metric": "rmse"},
+        dtrain=dtrain,
+        evals=[(dtrain, "train"), (dvalid, "valid")],
+        verbose_eval=False,
+        num_boost_round=num_boost_round,
+        early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+        xgb_model=booster,
+    )
+    # Leave out the rounds after the best one
+    return booster[: booster.best_iteration + 1]
+
+
+def train_full(data, kolommen=KOLOMMEN, params=PARAMS):
+    """
+        Trains from scratch
+    """
+    train, valid, _ = _split(data)
+    return _train(train, valid, kolommen, params, NUM_BOOST_ROUND)
+
+
+def train_warm(booster, nieuw, kolommen=KOLOMMEN, params=PARAMS):
+    """
+        Adds boosting rounds to booster, trained on nieuw (the new hours)
+
+        :return booster, None when there are too few new hours
+    """
+    train, valid, _ = _split(nieuw)
+    if len(nieuw) < MIN_WARM_ROWS or len(train) == 0 or len(valid) == 0:
+        return None
+    return _train(train, valid, kolommen, params, WARM_BOOST_ROUND, booster)
+
+
+def trainen(conn, kolommen=KOLOMMEN, params=PARAMS, directory=DIRECTORY, full=False):
+    """
+        Brings the artifact up to date with the dataset
+
+        :return (booster, metadata)
+    """
+    data = inlezen_data(conn, kolommen)
+    if len(data) == 0:
+        raise ValueError("Dataset is empty, run build_dataset.py first")
+
+    last = int(tijdas.index_naar_epoch(data.index).max())
+    cutoff = last - int(OVERLAP.total_seconds())
+    instellingen = instellingen_fingerprint(kolommen, params)
+    fingerprint = data_fingerprint(data)
+
+    booster, meta = (None, None) if full else laden(directory)
+
+    if meta is not None and meta["instellingen"] != instellingen:
+        logger.info("Model settings changed, training from scratch")
+        booster = None
+    elif meta is not None and meta["fingerprint"] == fingerprint:
+        logger.info(f"Dataset unchanged since {meta['getraind']}, model is up to date")
+        return booster, meta
+    elif meta is not None and meta["warm_starts"] >= MAX_WARM_STARTS:
+        logger.info(f"{meta['warm_starts']} warm starts, training from scratch")
+        booster = None
+    elif meta is not None:
+        # The hours before the cutoff of the last training must be unchanged
+        epochs = tijdas.index_naar_epoch(data.index)
+        stabiel = data[epochs < meta["cutoff"]]
+        if data_fingerprint(stabiel) != meta["stabiel"]:
+            logger.info("Older hours of the dataset changed, training from scratch")
+            booster = None
+
+    if booster is None:
+        logger.info(f"Training from scratch on {len(data)} hours")
+        booster = train_full(data, kolommen, params)
+        warm_starts = 0
+    else:
+        nieuw = data[tijdas.index_naar_epoch(data.index) >= meta["cutoff"]]
+        warm = train_warm(booster, nieuw, kolommen, params)
+        if warm is None:
+            logger.info(f"Only {len(nieuw)} new hours, model of {meta['getraind']} is kept")
+            return booster, meta
+        logger.info(f"Warm start on {len(nieuw)} new hours")
+        booster = warm
+        warm_starts = meta["warm_starts"] + 1
+
+    # Test rows of all hours, none of them was trained on
+    scores = _scores(booster, _split(data)[2], kolommen)
+
+    epochs = tijdas.index_naar_epoch(data.index)
+    meta = {
+        "getraind": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "instellingen": instellingen,
+        "kolommen": list(kolommen),
+        "params": params,
+        "fingerprint": fingerprint,
+        "stabiel": data_fingerprint(data[epochs < cutoff]),
+        "cutoff": cutoff,
+        "laatste": last,
+        "rijen": len(data),
+        "rounds": booster.num_boosted_rounds(),
+        "warm_starts": warm_starts,
+        **scores,
+    }
+    opslaan(booster, meta, directory)
+    logger.info(f"Model saved: {meta['rounds']} rounds, test r² {meta['r2']}, RMSE {meta['rmse']}")
+    return booster, meta
+
+
+def voorspellen(booster, meta, data):
+    """
+        Energy for the rows of data with the columns the model was trained on
+
+        :return numpy array, energy per row (as in the dataset)
+    """
+    return booster.predict(xgb.DMatrix(data=data[meta["kolommen"]]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the XGBoost model on the dataset")
+    parser.add_argument("--full", action="store_true", help="train from scratch")
+    args = parser.parse_args()
+
+    conn = storage.connect()
+    trainen(conn, full=args.full)
+    conn.close()
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+
+"""
+    Search for the best parameters of the XGBoost model on the dataset,
+    the grid search of XGBoost_testen.ipynb for the solar panels
+
+    Usage: python tunen.py [--workers N] [--threads N] [--serieel] [--opnieuw]
+
+    - Every combination of GRID is a trial: cross validation (xgb.cv) with
+      early stopping, so a trial stops when the test rmse doesn't improve
+    - Trials run in a pool of processes, each XGBoost limited to --threads
+      threads, so the processes don't compete for the same cores
+    - Results are kept in table tuning_trials, by parameters and the
+      fingerprint of the data and settings: a rerun only does the
+      combinations that are new. --opnieuw does all of them again.
+    - --serieel runs the trials one after another in this process with all
+      threads (as the notebook did), to compare the trials per second.
+      python benchmark.py tunen compares both on generated data.
+"""
+
+import argparse
+import coloredlogs, logging
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import pandas as pd
+import xgboost as xgb
+
+import storage
+import trainen
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
+
+TABLE = "tuning_trials"
+
+# Search grid, every combination is a trial
+# - eta aka learning_rate: kleinere stappen voorkomt overfitting, range: 0-1 (0.3)
+# - gamma aka min_split_loss: minimum wat een split aan verbetering moet geven, range: 0--> inf (0)
+# - max_depth: maximum diepte van de tree, te groot is risico overfitting (6)
+# - lambda: L2 regularisatie (1)
+GRID = {
+    "eta": [0.05, 0.1, 0.3],
+    "gamma": [0, 1, 10],
+    "max_depth": [3, 6, 10],
+    "lambda": [1, 5],
+}
+
+BASE_PARAMS = {"objective": "reg:squarederror", "eval_metric": "rmse"}
+
+# Cross validation, as in XGBoost_testen.ipynb
+CV = {"nfold": 5, "num_boost_round": 500, "early_stopping_rounds": 3, "seed": 42}
+
+# Threads per process
+THREADS = 2
+
+
+def combinaties(grid=GRID):
+    """
+        All combinations of the grid, as dicts of parameters
+    """
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def _sleutel(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def cache_fingerprint(data, kolommen=trainen.KOLOMMEN):
+    """
+        Fingerprint of the data and everything that makes a trial
+        other than its parameters
+    """
+    settings = {
+        "data": trainen.data_fingerprint(data),
+        "kolommen": list(kolommen),
+        "label": trainen.LABEL,
+        "base": BASE_PARAMS,
+        "cv": CV,
+        "xgboost": xgb.__version__,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def prepare_tables(conn):
+    storage.create_table(
+        conn,
+        TABLE,
+        {
+            "fingerprint": "TEXT",
+            "params": "TEXT",
+            "train_rmse": "REAL",
+            "train_std": "REAL",
+            "test_rmse": "REAL",
+            "test_std": "REAL",
+            "rounds": "INTEGER",
+            "seconds": "REAL",
+        },
+        ["fingerprint", "params"],
+    )
+    conn.commit()
+
+
+# The data of a worker process, set once by _init_worker
+_dmatrix = None
+_threads = None
+
+
+def _init_worker(X, y, threads):
+    global _dmatrix, _threads
+    _threads = threads
+    _dmatrix = xgb.DMatrix(data=X, label=y, nthread=threads)
+
+
+def trial(params):
+    """
+        Cross validation with params on the data of this process
+
+        :return (params, dict with the last row of the cv and time)
+    """
+    full_params = {**BASE_PARAMS, **params}
+    if _threads is not None:
+        full_params["nthread"] = _threads
+
+    start = time.perf_counter()
+    cv = xgb.cv(dtrain=_dmatrix, params=full_params, metrics="rmse", verbose_eval=False, **CV)
+    last = cv.iloc[-1]
+    return params, {
+        "train_rmse": float(last["train-rmse-mean"]),
+        "train_std": float(last["train-rmse-std"]),
+        "test_rmse": float(last["test-rmse-mean"]),
+        "test_std": float(last["test-rmse-std"]),
+        "rounds": len(cv),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def aantal_workers(threads=THREADS):
+    """
+        Processes to use all cores with threads threads each
+    """
+    return max(1, (os.cpu_count() or 1) // threads)
+
+
+def uitvoeren(X, y, trials, workers=None, threads=THREADS):
+    """
+        Runs the trials, in a pool of workers processes with threads
+        threads each. workers=1 runs them in this process.
+
+        :return iterator of (params, result), in the order they finish
+    """
+    if workers == 1:
+        _init_worker(X, y, threads)
+        for params in trials:
+            yield trial(params)
+        return
+
+    if workers is None:
+        workers = aantal_workers(threads)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(X, y, threads)
+    ) as executor:
+        futures = [executor.submit(trial, params) for params in trials]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def resultaten(conn, fingerprint):
+    """
+        All trials of fingerprint, best (lowest test rmse) first
+    """
+    data = pd.read_sql(
+        f"SELECT * FROM {TABLE} WHERE fingerprint = ? ORDER BY test_rmse;",
+        conn,
+        params=(fingerprint,),
+    )
+    params = pd.DataFrame([json.loads(p) for p in data.pop("params")], index=data.index)
+    return params.join(data.drop(columns="fingerprint"))
+
+
+def tunen(conn, grid=GRID, workers=None, threads=THREADS, opnieuw=False, kolommen=trainen.KOLOMMEN):
+    """
+        Runs the trials of grid that are not in the cache yet
+
+        :return DataFrame with all trials for this data, best first
+    """
+    if workers is None:
+        workers = aantal_workers(threads)
+
+    prepare_tables(conn)
+    data = trainen.inlezen_data(conn, kolommen)
+    fingerprint = cache_fingerprint(data, kolommen)
+
+    gedaan = {
+        row[0]
+        for row in conn.execute(f"SELECT params FROM {TABLE} WHERE fingerprint = ?;", (fingerprint,))
+    }
+    trials = [p for p in combinaties(grid) if opnieuw or _sleutel(p) not in gedaan]
+    logger.info(
+        f"{len(trials)} trials to run, {len(combinaties(grid)) - len(trials)} from the cache "
+        f"({len(data)} hours)"
+    )
+
+    if len(trials) > 0:
+        columns = ["fingerprint", "params", "train_rmse", "train_std", "test_rmse", "test_std", "rounds", "seconds"]
+        start = time.perf_counter()
+        # Every result is saved when it is there, an interrupted run keeps what is done
+        for i, (params, result) in enumerate(
+            uitvoeren(data[kolommen].to_numpy(), data[trainen.LABEL].to_numpy(), trials, workers, threads), 1
+        ):
+            logger.info(f"{i}/{len(trials)} {params}: test rmse {result['test_rmse']:.2f}, {result['rounds']} rounds")
+            storage.upsert(
+                conn,
+                TABLE,
+                columns,
+                [(fingerprint, _sleutel(params), *[result[name] for name in columns[2:]])],
+                ["fingerprint", "params"],
+            )
+        duur = time.perf_counter() - start
+        logger.info(
+            f"{len(trials)} trials in {duur:.1f} s: {len(trials) / duur:.2f} trials/s "
+            f"({workers} workers x {threads} threads)"
+        )
+
+    return resultaten(conn, fingerprint)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter search for the XGBoost model")
+    parser.add_argument("--workers", type=int, help="processes (default: cores / threads)")
+    parser.add_argument("--threads", type=int, default=THREADS, help="XGBoost threads per process")
+    parser.add_argument("--serieel", action="store_true", help="one process with all threads, as a baseline")
+    parser.add_argument("--opnieuw", action="store_true", help="also run the trials in the cache")
+    args = parser.parse_args()
+
+    workers, threads = args.workers, args.threads
+    if args.serieel:
+        workers, threads = 1, os.cpu_count()
+
+    conn = storage.connect()
+    grid = tunen(conn, workers=workers, threads=threads, opnieuw=args.opnieuw)
+    conn.close()
+
+    print(f"\nBeste parameters:\n{grid.head(5).to_string()}")
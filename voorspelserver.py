@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+
+"""
+    Local service for the expected energy of the solar panels
+
+    Usage: python voorspelserver.py [--host 127.0.0.1] [--port 8050] [--socket PATH]
+
+    The model (trainen.py), the latest weather forecast with its features
+    and the position of the sun are loaded once, the energy per hour is
+    computed when loading. Requests only select from that, so they take
+    milliseconds. Every CHECK_INTERVAL seconds the service checks for a new
+    model artifact, forecast or dataset and loads again when one is there.
+
+    GET /voorspelling?dagen=3&per=uur   expected kWh per hour (or per=dag,
+                                        per local day) for the next dagen days
+    GET /status                         what is loaded
+
+    With --socket the service listens on a Unix socket instead of TCP, e.g.
+    curl --unix-socket PATH http://localhost/voorspelling?per=dag
+"""
+
+import argparse
+import coloredlogs, logging
+import http.server
+import json
+import math
+import os
+import socketserver
+import threading
+import urllib.parse
+
+import pandas as pd
+
+import features
+import locaties
+import ophalen_weersvoorspelling
+import storage
+import tijdas
+import trainen
+import zonnestand
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+coloredlogs.install(level="INFO", fmt="%(asctime)s %(levelname)s %(message)s")
+
+HOST = "127.0.0.1"
+PORT = 8050
+
+# Seconds between checks for a new model, forecast or dataset
+CHECK_INTERVAL = 60
+
+DAGEN = trainen.HORIZON.days
+PER = ("uur", "dag")
+
+
+class Voorspeller:
+    """
+        Model, forecast and the expected energy per hour, in memory
+    """
+
+    def __init__(self, database=storage.DATABASE, directory=trainen.DIRECTORY):
+        self.database = database
+        self.directory = directory
+        self.energie = None
+        self.versie = None
+        self.geladen = None
+        self._lock = threading.Lock()
+
+    def versie_op_schijf(self):
+        """
+            What the energy is computed from: the model artifact, the
+            latest forecast and the last hour of the dataset (lag features)
+        """
+        meta_path = os.path.join(self.directory, trainen.META_FILE)
+        model = os.stat(meta_path).st_mtime_ns if os.path.exists(meta_path) else None
+
+        conn = storage.connect(self.database)
+        try:
+            forecast = conn.execute(
+                f"SELECT MAX(issue_time) FROM {ophalen_weersvoorspelling.HISTORY_TABLE};"
+            ).fetchone()[0]
+            dataset = conn.execute("SELECT MAX(epoch) FROM dataset;").fetchone()[0]
+        finally:
+            conn.close()
+        return model, forecast, dataset
+
+    def laden(self):
+        """
+            Loads model and forecast and computes the energy per hour
+        """
+        versie = self.versie_op_schijf()
+        booster, meta = trainen.laden(self.directory)
+        if booster is None:
+            raise FileNotFoundError(f"No model in {self.directory}, run trainen.py first")
+
+        conn = storage.connect(self.database)
+        try:
+            voorspelling = ophalen_weersvoorspelling.voorspelling_op(conn)
+            voorspelling.index.name = "Time"
+
+            # KNMI geeft niet voor ieder uur een voorspelling, interpoleren naar per uur
+            voorspelling = voorspelling.resample("1h").interpolate(method="linear")
+
+            # Features (history from the dataset) and the position of the sun
+            data = voorspelling.join(features.voor_voorspelling(conn, voorspelling))
+            latitude, longitude = locaties.get_location()
+            zon = zonnestand.get_solar_position(latitude, longitude, data.index)
+            data["solar_altitude"] = zon["altitude"]
+            data["solar_azimuth"] = zon["azimuth"]
+        finally:
+            conn.close()
+
+        # Energie per kWh, niet per Wh
+        energie = pd.Series(
+            trainen.voorspellen(booster, meta, data) / 1000, index=data.index, name="kwh"
+        )
+
+        with self._lock:
+            self.energie = energie
+            self.versie = versie
+            self.geladen = {
+                "model": meta["getraind"],
+                "forecast": versie[1],
+                "dataset": None if versie[2] is None else str(tijdas.naar_index([versie[2]])[0]),
+                "uren": len(energie),
+            }
+        logger.info(f"Loaded model of {meta['getraind']} and forecast of {versie[1]}")
+
+    def bijwerken(self):
+        """
+            Loads again when model, forecast or dataset changed
+        """
+        if self.versie_op_schijf() != self.versie:
+            self.laden()
+
+    def bewaken(self, interval=CHECK_INTERVAL):
+        """
+            Checks for changes every interval seconds (run in a thread)
+        """
+        stop = threading.Event()
+        while not stop.wait(interval):
+            try:
+                self.bijwerken()
+            except Exception as e:
+                logger.error(f"Loading failed, keeping the previous forecast: {e}")
+
+    def voorspelling(self, dagen=DAGEN, per="uur", nu=None):
+        """
+            Expected energy for the next dagen days
+
+            :param per: "uur": UTC hours from the current hour on,
+                        "dag": whole local days from today on (today from
+                        midnight, as far as the forecast goes), dagen is
+                        rounded up to whole days
+            :return list of {"tijd": ..., "kwh": ...}
+        """
+        with self._lock:
+            energie = self.energie
+        if energie is None:
+            return None
+
+        nu = pd.Timestamp.now(tz="UTC") if nu is None else pd.Timestamp(nu)
+        if nu.tz is None:
+            nu = nu.tz_localize("UTC")
+
+        if per == "dag":
+            # Local midnights, a day with a clock change has 23 or 25 hours
+            start = nu.tz_convert(tijdas.LOCAL_TZ).normalize()
+            stop = start + pd.DateOffset(days=math.ceil(dagen))
+            energie = energie[(energie.index >= start) & (energie.index < stop)]
+            lokaal = energie.index.tz_convert(tijdas.LOCAL_TZ)
+            energie = energie.groupby(lokaal.strftime("%Y-%m-%d")).sum()
+            tijden = energie.index
+        else:
+            start = nu.floor("h")
+            energie = energie[(energie.index >= start) & (energie.index < start + pd.Timedelta(days=dagen))]
+            tijden = energie.index.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        return [
+            {"tijd": tijd, "kwh": round(float(kwh), 3)} for tijd, kwh in zip(tijden, energie.to_numpy())
+        ]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+        GET /voorspelling and /status, answers in JSON
+    """
+
+    voorspeller = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/status":
+            self._json(200, {"geladen": self.voorspeller.geladen})
+            return
+        if url.path != "/voorspelling":
+            self._json(404, {"fout": f"unknown path {url.path}"})
+            return
+
+        try:
+            dagen = float(query.get("dagen", [DAGEN])[0])
+        except ValueError:
+            self._json(400, {"fout": "dagen must be a number"})
+            return
+        per = query.get("per", ["uur"])[0]
+        if per not in PER or dagen <= 0:
+            self._json(400, {"fout": f"per must be one of {', '.join(PER)}, dagen > 0"})
+            return
+
+        energie = self.voorspeller.voorspelling(dagen, per)
+        if energie is None:
+            self._json(503, {"fout": "no forecast loaded"})
+            return
+        self._json(200, {"per": per, **self.voorspeller.geladen, "energie": energie})
+
+    def _json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def maak_server(voorspeller, host=HOST, port=PORT, socket_path=None):
+    """
+        HTTP server on host:port, or on the Unix socket socket_path
+    """
+    handler = type("VoorspelHandler", (Handler,), {"voorspeller": voorspeller})
+    if socket_path is None:
+        return http.server.ThreadingHTTPServer((host, port), handler)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return UnixHTTPServer(socket_path, handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local service for the expected energy")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--database", default=storage.DATABASE)
+    args = parser.parse_args()
+
+    voorspeller = Voorspeller(args.database)
+    voorspeller.laden()
+    threading.Thread(target=voorspeller.bewaken, daemon=True).start()
+
+    server = maak_server(voorspeller, args.host, args.port, args.socket)
+    logger.info(f"Listening on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+"""
+    Position of the sun (altitude, azimuth) per location and hour
+    Computed with pysolar for the hours asked for, the vectorized
+    computation is faster than reading stored positions back.
+"""
+
+import logging
+
+import pandas as pd
+import pysolar
+
+
+# Get logger
+logger = logging.getLogger(__name__)
+
+
+def get_solar_position(latitude, longitude, index):
+    """
+        Position of the sun at latitude, longitude for the times in index
+
+        :param index: DatetimeIndex with timezone
+        :return DataFrame with altitude and azimuth, index as given
+    """
+    logger.debug(f"Position of the sun at ({latitude}, {longitude}): {len(index)} hours")
+    return pd.DataFrame(
+        {
+            "altitude": pysolar.solar.get_altitude_fast(latitude, longitude, index),
+            "azimuth": pysolar.solar.get_azimuth_fast(latitude, longitude, index),
+        },
+        index=index,
+        dtype=float,
+    )
+
+
+if __name__ == "__main__":
+    print("\n\nThe zonnestand.py is directly called, not supposed to do so...\n\n")